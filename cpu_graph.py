@@ -20,16 +20,40 @@ class GraphWidget(qtw.QWidget):
         self.scale = scale
         self.crit_val = crit_val
         self.values = deque([self.minimum] * data_width, maxlen=data_width)
+        self.start_value = self.minimum     # The value before values[0], where the first segment starts
+        # The background and the plot are cached, so a tick only scrolls the plot and draws one segment
+        self.background = None
+        self.plot = None
+        self.plot_brush = None
         self.setFixedWidth(data_width * scale)
 
     def add_value(self, value):
         value = max(value, self.minimum)
         value = min(value, self.maximum)
+        last_value = self.values[-1]
+        if len(self.values) == self.values.maxlen:
+            self.start_value = self.values[0]
         self.values.append(value)
+        if self.plot is not None:
+            self.scroll_plot(last_value, value)
         self.update()
 
-    def paintEvent(self, paint_event):  # Overwrite default
-        painter = qtg.QPainter(self)
+    def resizeEvent(self, resize_event):
+        # Everything cached depends on the height, so it's all redrawn at the new size
+        self.background = None
+        self.plot = None
+        super().resizeEvent(resize_event)
+
+    def new_pixmap(self):
+        ratio = self.devicePixelRatioF()
+        pixmap = qtg.QPixmap(self.size() * ratio)
+        pixmap.setDevicePixelRatio(ratio)
+        pixmap.fill(qtc.Qt.transparent)
+        return pixmap
+
+    def render_background(self):
+        self.background = self.new_pixmap()
+        painter = qtg.QPainter(self.background)
 
         brush = qtg.QBrush(qtg.QColor(48, 48, 48))
         painter.setBrush(brush)
@@ -46,36 +70,75 @@ class GraphWidget(qtw.QWidget):
         pen.setColor(self.crit_color)
         painter.setPen(pen)
         painter.drawLine(0, crit_y, self.width(), crit_y)
+        painter.end()
 
         gradient = qtg.QLinearGradient(qtc.QPointF(0, self.height()), qtc.QPointF(0, 0))
         gradient.setColorAt(0, self.good_color)
         gradient.setColorAt(self.warn_val / (self.maximum - self.minimum), self.warn_color)
         gradient.setColorAt(self.crit_val / (self.maximum - self.minimum), self.crit_color)
+        self.plot_brush = qtg.QBrush(gradient)
 
-        brush = qtg.QBrush(gradient)
-        painter.setBrush(brush)
+    def plot_painter(self):
+        painter = qtg.QPainter(self.plot)
+        painter.setBrush(self.plot_brush)
         painter.setPen(qtc.Qt.NoPen)
+        return painter
+
+    def render_plot(self):
+        # One path for the whole series, as a drawPath per value gets slow once data_width is in the thousands
+        self.plot = self.new_pixmap()
+        ys = self.values_to_y([self.start_value, *self.values])
+        path = qtg.QPainterPath()
+        path.moveTo(0, self.height())
+        path.lineTo(0, ys[0])
+        for indx in range(len(self.values)):
+            self.curve_to(path, indx, ys[indx], ys[indx + 1])
+        path.lineTo(len(self.values) * self.scale, self.height())
+        path.closeSubpath()
+        painter = self.plot_painter()
+        painter.drawPath(path)
+        painter.end()
+
+    def scroll_plot(self, last_value, value):
+        """Move the plot left by one value and draw the newest segment in the gap on the right"""
+        ratio = self.plot.devicePixelRatio()
+        self.plot.scroll(-round(self.scale * ratio), 0, self.plot.rect())
+        painter = self.plot_painter()
+        last_x = (len(self.values) - 1) * self.scale
+        painter.setCompositionMode(qtg.QPainter.CompositionMode_Source)
+        painter.fillRect(last_x, 0, self.width() - last_x, self.height(), qtc.Qt.transparent)
+        painter.setCompositionMode(qtg.QPainter.CompositionMode_SourceOver)
+        self.draw_segment(painter, len(self.values) - 1, last_value, value)
+        painter.end()
+
+    def draw_segment(self, painter, indx, last_value, value):
+        last_x = indx * self.scale
+        last_y = self.val_to_y(last_value)
+        path = qtg.QPainterPath()
+        path.moveTo(last_x + self.scale, self.height())
+        path.lineTo(last_x, self.height())
+        path.lineTo(last_x, last_y)
+        self.curve_to(path, indx, last_y, self.val_to_y(value))
+        painter.drawPath(path)
+
+    def curve_to(self, path, indx, last_y, y):
+        """Continue path from the point of value indx - 1 to that of value indx"""
+        last_x = indx * self.scale
+        x = last_x + self.scale
+        # path.lineTo(x, y)
+        c_x = round(self.scale * .5) + last_x
+        c1 = (c_x, last_y)
+        c2 = (c_x, y)
+        path.cubicTo(*c1, *c2, x, y)
 
-        self.start_value = getattr(self, 'start_value', self.minimum)
-        last_value = self.start_value
-        self.start_value = self.values[0]
-        for indx, value in enumerate(self.values):
-            x = (indx + 1) * self.scale
-            last_x = indx * self.scale
-            y = self.val_to_y(value)
-            last_y = self.val_to_y(last_value)
-            path = qtg.QPainterPath()
-            path.moveTo(x, self.height())
-            path.lineTo(last_x, self.height())
-            path.lineTo(last_x, last_y)
-            # path.lineTo(x, y)
-            c_x = round(self.scale * .5) + last_x
-            c1 = (c_x, last_y)
-            c2 = (c_x, y)
-            path.cubicTo(*c1, *c2, x, y)
-            painter.drawPath(path)
-            last_value = value
-
+    def paintEvent(self, paint_event):  # Overwrite default
+        if self.background is None:
+            self.render_background()
+        if self.plot is None:
+            self.render_plot()
+        painter = qtg.QPainter(self)
+        painter.drawPixmap(0, 0, self.background)
+        painter.drawPixmap(0, 0, self.plot)
 
     def val_to_y(self, value):
         data_range = self.maximum - self.minimum
@@ -84,6 +147,12 @@ class GraphWidget(qtw.QWidget):
         y = self.height() - y_offset
         return y
 
+    def values_to_y(self, values):
+        """val_to_y over a whole series, with the widget's height and range looked up once"""
+        data_range = self.maximum - self.minimum
+        height = self.height()
+        return [height - round(value / data_range * height) for value in values]
+
 
 class MainWindow(qtw.QMainWindow):
 
@@ -1,22 +1,68 @@
+import os
 import sys
 from PyQt5 import QtWidgets as qtw
 from PyQt5 import QtGui as qtg
 from PyQt5 import QtCore as qtc
+from file_hasher_engine import ALGORITHMS, HashCache, HashManager
 
 
 class HashForm(qtw.QWidget):
 
-    submitted = qtc.pyqtSignal(str, str, int)
+    submitted = qtc.pyqtSignal(str, str, int, dict)
+    placeholder = 'Click to select…'
 
     def __init__(self):
         super().__init__()
         self.setLayout(qtw.QFormLayout())
-        self.source_path = qtw.QPushButton('Click to select…', clicked=self.on_source_click)
+        self.source_path = qtw.QPushButton(self.placeholder, clicked=self.on_source_click)
         self.layout().addRow('Source Path', self.source_path)
-        self.destination_file = qtw.QPushButton('Click to select…', clicked=self.on_dest_click)
+        self.destination_file = qtw.QPushButton(self.placeholder, clicked=self.on_dest_click)
         self.layout().addRow('Destination File', self.destination_file)
-        self.threads = qtw.QSpinBox(minimum=1, maximum=7, value=2)
+        self.mode = qtw.QComboBox()
+        self.mode.addItem('Hash files', 'hash')
+        self.mode.addItem('Find duplicates', 'dedupe')
+        self.mode.addItem('Verify manifest', 'manifest')
+        self.layout().addRow('Mode', self.mode)
+        self.manifest = qtw.QPushButton(self.placeholder, clicked=self.on_manifest_click)
+        self.layout().addRow('Manifest', self.manifest)
+        self.threads = qtw.QSpinBox(minimum=1, maximum=256, value=os.cpu_count() or 2)
         self.layout().addRow('Threads', self.threads)
+        self.backend = qtw.QComboBox()
+        self.backend.addItem('Thread pool', 'threads')
+        self.backend.addItem('Process pool', 'processes')
+        self.layout().addRow('Backend', self.backend)
+        self.chunk_size = qtw.QSpinBox(minimum=4, maximum=65536, value=1024, suffix=' KiB', singleStep=256)
+        self.layout().addRow('Chunk Size', self.chunk_size)
+        self.read_strategy = qtw.QComboBox(
+            toolTip='Automatic maps large local files with the process pool only. Memory map with the thread pool '
+                    'crashes the application if a file is truncated while it is being hashed.')
+        for label, strategy in (('Automatic', 'auto'), ('Memory map', 'mmap'), ('Buffered read', 'read')):
+            self.read_strategy.addItem(label, strategy)
+        self.layout().addRow('Read Strategy', self.read_strategy)
+        self.algorithms = qtw.QWidget()
+        self.algorithms.setLayout(qtw.QHBoxLayout())
+        self.algorithms.layout().setContentsMargins(0, 0, 0, 0)
+        for name in ALGORITHMS:
+            self.algorithms.layout().addWidget(qtw.QCheckBox(name, checked=name == 'md5'))
+        self.layout().addRow('Algorithms', self.algorithms)
+        self.split_size = qtw.QSpinBox(minimum=0, maximum=1024 * 1024, value=1024, suffix=' MiB', singleStep=256,
+                                       specialValueText='Never')
+        self.split_size.setToolTip('Hash leaves of larger files in parallel (blake2b-tree only)')
+        self.layout().addRow('Split Files Above', self.split_size)
+        self.recursive = qtw.QCheckBox('Include subdirectories')
+        self.layout().addRow('Recursive', self.recursive)
+        self.include = qtw.QLineEdit(placeholderText='e.g. *.iso;*.img')
+        self.layout().addRow('Include', self.include)
+        self.exclude = qtw.QLineEdit(placeholderText='e.g. .git;*.tmp')
+        self.layout().addRow('Exclude', self.exclude)
+        self.symlinks = qtw.QComboBox()
+        for label, policy in (('Skip', 'skip'), ('Follow file links', 'files'), ('Follow all links', 'all')):
+            self.symlinks.addItem(label, policy)
+        self.layout().addRow('Symlinks', self.symlinks)
+        self.use_cache = qtw.QCheckBox('Skip files unchanged since the last run', checked=True)
+        self.layout().addRow('Cache', self.use_cache)
+        self.verify = qtw.QCheckBox('Re-read every file and compare with the cache')
+        self.layout().addRow('Verify', self.verify)
         submit = qtw.QPushButton('Go', clicked=self.on_submit)
         self.layout().addRow(submit)
 
@@ -30,50 +76,47 @@ class HashForm(qtw.QWidget):
         if filename:
             self.destination_file.setText(filename)
 
-    def on_submit(self):
-        self.submitted.emit(self.source_path.text(), self.destination_file.text(), self.threads.value())
-
-
-class HashRunner(qtc.QRunnable):
-
-    file_lock = qtc.QMutex()    # Will be instantiated for the class, and thus shared between objects
-
-    def __init__(self, infile, outfile):
-        super().__init__()
-        self.infile = infile
-        self.outfile = outfile
-        self.hasher = qtc.QCryptographicHash(qtc.QCryptographicHash.Md5)
-        self.setAutoDelete(True)        # Objects will be deleted after run
-
-    def run(self):
-        print(f'hashing {self.infile}')
-        self.hasher.reset()
-        with open(self.infile, 'rb') as fh:
-            self.hasher.addData(fh.read())
-        hash_string = bytes(self.hasher.result().toHex()).decode('UTF-8')
-        with qtc.QMutexLocker(self.file_lock):
-            with open(self.outfile, 'a', encoding='utf-8') as out:
-                out.write(f'{self.infile}\t{hash_string}\n')
-
+    def on_manifest_click(self):
+        filename, _ = qtw.QFileDialog.getOpenFileName()
+        if filename:
+            self.manifest.setText(filename)
 
-class HashManager(qtc.QObject):
+    def selected_path(self, button):
+        return '' if button.text() == self.placeholder else button.text()
 
-    finished = qtc.pyqtSignal()
+    @staticmethod
+    def split_patterns(text):
+        return [pattern.strip() for pattern in text.split(';') if pattern.strip()]
 
-    def __init__(self):
-        super().__init__()
-        self.pool = qtc.QThreadPool.globalInstance()
-
-    @qtc.pyqtSlot(str, str, int)
-    def do_hashing(self, source, destination, threads):
-        self.pool.setMaxThreadCount(threads)
-        qdir = qtc.QDir(source)
-        for filename in qdir.entryList(qtc.QDir.Files):
-            filepath = qdir.absoluteFilePath(filename)
-            runner = HashRunner(filepath, destination)
-            self.pool.start(runner)
-        self.pool.waitForDone()
-        self.finished.emit()
+    def on_submit(self):
+        source, destination = self.selected_path(self.source_path), self.selected_path(self.destination_file)
+        mode, manifest = self.mode.currentData(), self.selected_path(self.manifest)
+        if mode == 'manifest' and not manifest:
+            qtw.QMessageBox.critical(self, 'Error', 'Select the manifest to verify.')
+            return
+        if mode != 'manifest' and not source:
+            qtw.QMessageBox.critical(self, 'Error', 'Select the source directory.')
+            return
+        if not destination:
+            qtw.QMessageBox.critical(self, 'Error', 'Select the destination file.')
+            return
+        algorithms = [box.text() for box in self.algorithms.findChildren(qtw.QCheckBox) if box.isChecked()]
+        options = {
+            'mode': mode,
+            'manifest': manifest,
+            'chunk_size': self.chunk_size.value() * 1024,
+            'read_strategy': self.read_strategy.currentData(),
+            'algorithms': algorithms or ['md5'],
+            'backend': self.backend.currentData(),
+            'split_size': self.split_size.value() * 1024 * 1024,
+            'recursive': self.recursive.isChecked(),
+            'include': self.split_patterns(self.include.text()),
+            'exclude': self.split_patterns(self.exclude.text()),
+            'symlinks': self.symlinks.currentData(),
+            'cache': HashCache.default_path if self.use_cache.isChecked() or self.verify.isChecked() else None,
+            'verify': self.verify.isChecked(),
+        }
+        self.submitted.emit(source, destination, self.threads.value(), options)
 
 
 class MainWindow(qtw.QMainWindow):
@@ -89,12 +132,46 @@ class MainWindow(qtw.QMainWindow):
         self.manager.moveToThread(self.manager_thread)
         self.manager_thread.start()
         form.submitted.connect(self.manager.do_hashing)
-        form.submitted.connect(lambda x, y, z: self.statusBar().showMessage(f'Processing files in {x} into {y} with {z} threads.'))
-        self.manager.finished.connect(lambda: self.statusBar().showMessage('Finished'))
+        form.submitted.connect(lambda x, y, z, *_: self.statusBar().showMessage(f'Processing files in {x} into {y} with {z} threads.'))
+        form.submitted.connect(lambda: form.setEnabled(False))
+        self.manager.finished.connect(lambda: form.setEnabled(True))
+        self.manager.finished.connect(self.on_finished)
+
+        # Lambdas rather than the manager's methods, so the calls aren't queued behind the running job
+        toolbar = self.addToolBar('Job')
+        toolbar.addAction('Pause', lambda: self.manager.pause())
+        toolbar.addAction('Resume', lambda: self.manager.resume())
+        toolbar.addAction('Cancel', lambda: self.manager.cancel())
+        self.progress_bar = qtw.QProgressBar(maximum=1000)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.manager.progress.connect(self.on_progress)
 
         # End main UI code
         self.show()
 
+    def on_finished(self):
+        if self.manager.summary.get('error'):
+            self.statusBar().showMessage(f"Failed: {self.manager.summary['error']}")
+            return
+        message = 'Cancelled' if self.manager.job.cancelled else 'Finished'
+        if self.manager.summary.get('failed'):
+            message += f", {self.manager.summary['failed']} files could not be hashed"
+        if self.manager.summary.get('mismatched'):
+            message += f", {self.manager.summary['mismatched']} files no longer match (see the destination file)"
+        self.statusBar().showMessage(message)
+
+    def on_progress(self, progress):
+        if progress['bytes_found']:
+            self.progress_bar.setValue(round(1000 * progress['bytes_done'] / progress['bytes_found']))
+        eta = 'scanning…' if progress['eta'] is None else f"ETA {progress['eta']:.0f} s"
+        utilisation = progress['utilisation'].values()
+        average = sum(utilisation) / len(utilisation) if utilisation else 0
+        self.statusBar().showMessage(
+            f"{progress['files_done']}/{progress['files_found']} files ({progress['files_cached']} cached), "
+            f"{progress['bytes_done'] / 1e6:.0f}/{progress['bytes_found'] / 1e6:.0f} MB, "
+            f"{progress['rate'] / 1e6:.1f} MB/s, {eta}, {len(utilisation)} workers {average:.0%} busy, "
+            f"{progress['io_fraction']:.0%} of busy time reading")
+
 
 if __name__ == '__main__':
     app = qtw.QApplication(sys.argv)
@@ -0,0 +1,217 @@
+"""Benchmarks for the file_hasher hashing engine
+
+strategies: times buffered reads against mmap for a range of file sizes, and prints the size from which
+mmap wins. file_hasher_engine.MMAP_THRESHOLD is set from this. The files are hashed once to warm the
+page cache before timing, so the numbers show the cost of copying data out of the cache, which is
+what mmap saves, rather than the speed of the disk.
+
+pipeline: generates synthetic trees (many tiny files, a few huge ones, a mixed distribution), runs
+file_hasher_cli over each with every combination of thread count, chunk size, algorithms and backend,
+and writes files/s, MB/s and peak RSS to a JSON report. Each run is a fresh process so its peak RSS
+is its own; with the process backend that's the dispatcher only, not the workers. Pages of files
+hashed through mmap count towards RSS even though they are only page cache.
+
+compare: prints the throughput ratio of every configuration found in two pipeline reports.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import file_hasher_engine
+
+TREES = {
+    # name: (file count, function(rng) giving a file size) before --scale is applied to the count
+    'tiny': (20000, lambda rng: rng.randint(0, 4096)),
+    'huge': (4, lambda rng: rng.randint(192, 320) * 1024 * 1024),
+    'mixed': (2000, lambda rng: min(int(rng.lognormvariate(11, 2.5)), 512 * 1024 * 1024)),
+}
+
+
+def make_file(path, size, block_size=1024 * 1024):
+    with open(path, 'wb') as fh:
+        while size > 0:
+            fh.write(os.urandom(min(block_size, size)))
+            size -= block_size
+
+
+def time_hash(path, algorithms, chunk_size, strategy, repeat):
+    """Return the best of repeat timings of hashing path, after one untimed run to warm the page cache"""
+    file_hasher_engine.hash_file(path, algorithms, chunk_size, strategy)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        file_hasher_engine.hash_file(path, algorithms, chunk_size, strategy)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def benchmark_strategies(args):
+    print(f'{"size":>12} {"read MB/s":>10} {"mmap MB/s":>10} {"mmap/read":>10}')
+    crossover = None
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        for size_kib in args.sizes:
+            size = size_kib * 1024
+            path = os.path.join(directory, f'{size_kib}.bin')
+            make_file(path, size)
+            # Enough runs that every size gets roughly the same amount of data through it
+            repeat = max(args.repeat, min(1000, args.repeat * 64 * 1024 * 1024 // size))
+            read = time_hash(path, args.algorithms, args.chunk_size, 'read', repeat)
+            mapped = time_hash(path, args.algorithms, args.chunk_size, 'mmap', repeat)
+            print(f'{size:>12} {size / read / 1e6:>10.0f} {size / mapped / 1e6:>10.0f} {read / mapped:>10.2f}')
+            if mapped < read:
+                crossover = crossover or size
+            else:
+                crossover = None
+            os.remove(path)
+    if crossover:
+        print(f'mmap is faster from {crossover} bytes (MMAP_THRESHOLD is {file_hasher_engine.MMAP_THRESHOLD})')
+    else:
+        print('mmap was not faster at the largest size tried')
+
+
+def make_tree(root, name, scale, seed):
+    """Create tree name under root unless it's already there, returning its directory"""
+    count, size_of = TREES[name]
+    count = max(1, round(count * scale))
+    directory = os.path.join(root, f'{name}-{count}-{seed}')
+    marker = os.path.join(directory, '.complete')
+    if os.path.exists(marker):
+        return directory
+    rng = random.Random(seed)
+    block = rng.randbytes(1024 * 1024)
+    for index in range(count):
+        # A few levels of nesting with up to 100 entries per directory, like a real artifact tree
+        subdir = os.path.join(directory, *(f'd{index // 100 ** level % 100:02}' for level in (2, 1)))
+        os.makedirs(subdir, exist_ok=True)
+        size = size_of(rng)
+        with open(os.path.join(subdir, f'f{index:07}.bin'), 'wb') as fh:
+            fh.write(rng.randbytes(min(size, len(block))))
+            for _ in range(len(block), size, len(block)):
+                fh.write(block[:min(len(block), size - fh.tell())])
+    open(marker, 'w').close()
+    return directory
+
+
+def run_hasher(source, threads, chunk_kib, algorithms, backend, read_strategy):
+    """Hash source with file_hasher_cli in a new process, returning its final progress and peak RSS in KiB"""
+    with tempfile.TemporaryDirectory() as directory:
+        command = [sys.executable, '-m', 'file_hasher_cli', source, os.path.join(directory, 'out.txt'),
+                   '--recursive', '--exclude', '.complete', '--threads', str(threads), '--chunk-size',
+                   str(chunk_kib), '--backend', backend, '--read-strategy', read_strategy,
+                   '--progress-interval', '3600']
+        for algorithm in algorithms:
+            command += ['--algorithm', algorithm]
+        process = subprocess.Popen(command, stderr=subprocess.PIPE, text=True,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        stderr = process.stderr.read()
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise RuntimeError(f'{" ".join(command)} failed:\n{stderr}')
+    return json.loads(stderr.splitlines()[-1]), usage.ru_maxrss
+
+
+def benchmark_pipeline(args):
+    root = args.dir or os.path.join(tempfile.gettempdir(), 'file_hasher_benchmark')
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scale': args.scale,
+            'seed': args.seed,
+        },
+        'trees': {},
+        'results': [],
+    }
+    for name in args.trees:
+        source = make_tree(root, name, args.scale, args.seed)
+        for threads in args.threads:
+            for chunk_kib in args.chunk_sizes:
+                for algorithms in args.algorithms:
+                    for backend, read_strategy in itertools.product(args.backends, args.read_strategies):
+                        runs = [run_hasher(source, threads, chunk_kib, algorithms.split(','), backend, read_strategy)
+                                for _ in range(args.repeat)]
+                        progress, _ = min(runs, key=lambda run: run[0]['elapsed'])
+                        report['trees'][name] = {'files': progress['files_done'], 'bytes': progress['bytes_done']}
+                        result = {
+                            'tree': name,
+                            'threads': threads,
+                            'chunk_kib': chunk_kib,
+                            'algorithms': algorithms,
+                            'backend': backend,
+                            'read_strategy': read_strategy,
+                            'elapsed': progress['elapsed'],
+                            'files_per_s': progress['files_done'] / progress['elapsed'],
+                            'mb_per_s': progress['bytes_done'] / progress['elapsed'] / 1e6,
+                            'peak_rss_kib': max(rss for _, rss in runs),
+                        }
+                        report['results'].append(result)
+                        print(f"{name:>6} {threads:>3} threads {chunk_kib:>6} KiB {algorithms:>14} {backend:>9} "
+                              f"{read_strategy:>4}: "
+                              f"{result['files_per_s']:>9.0f} files/s {result['mb_per_s']:>8.1f} MB/s "
+                              f"{result['peak_rss_kib'] / 1024:>6.0f} MiB RSS")
+    with open(args.output, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Report written to {args.output}')
+
+
+def compare_reports(args):
+    def load(path):
+        with open(path, encoding='utf-8') as fh:
+            results = json.load(fh)['results']
+        return {(r['tree'], r['threads'], r['chunk_kib'], r['algorithms'], r['backend'],
+                 r.get('read_strategy', 'auto')): r for r in results}
+
+    before, after = load(args.before), load(args.after)
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        print(f'{key[0]:>6} {key[1]:>3} threads {key[2]:>6} KiB {key[3]:>14} {key[4]:>9} {key[5]:>4}: '
+              f"MB/s x{new['mb_per_s'] / old['mb_per_s'] if old['mb_per_s'] else float('nan'):.2f} "
+              f"files/s x{new['files_per_s'] / old['files_per_s']:.2f} "
+              f"RSS x{new['peak_rss_kib'] / old['peak_rss_kib']:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    strategies = subparsers.add_parser('strategies', help='find where mmap overtakes buffered reads')
+    strategies.add_argument('--sizes', type=int, nargs='+', metavar='KIB',
+                            default=[64, 256, 1024, 4096, 16384, 65536, 262144])
+    strategies.add_argument('--repeat', type=int, default=3)
+    strategies.add_argument('--algorithms', nargs='+', default=['md5'], choices=file_hasher_engine.ALGORITHMS)
+    strategies.add_argument('--chunk-size', type=int, default=file_hasher_engine.DEFAULT_CHUNK_SIZE)
+    strategies.add_argument('--dir', help='where to create the test files, to benchmark a particular disk')
+    strategies.set_defaults(run=benchmark_strategies)
+    pipeline = subparsers.add_parser('pipeline', help='time the whole hasher over synthetic trees')
+    pipeline.add_argument('--trees', nargs='+', choices=TREES, default=list(TREES))
+    pipeline.add_argument('--scale', type=float, default=1.0, help='multiplies the number of files in each tree')
+    pipeline.add_argument('--seed', type=int, default=0)
+    pipeline.add_argument('--threads', type=int, nargs='+', default=sorted({1, 4, os.cpu_count() or 1}))
+    pipeline.add_argument('--chunk-sizes', type=int, nargs='+', metavar='KIB', default=[64, 1024])
+    pipeline.add_argument('--algorithms', nargs='+', default=['md5', 'sha256', 'md5,sha256'],
+                          help='comma separated sets computed together, e.g. md5,sha256')
+    pipeline.add_argument('--backends', nargs='+', choices=('threads', 'processes'), default=['threads'])
+    pipeline.add_argument('--read-strategies', nargs='+', choices=('auto', 'mmap', 'read'), default=['auto'])
+    pipeline.add_argument('--repeat', type=int, default=1, help='runs per configuration, the fastest is kept')
+    pipeline.add_argument('--dir', help='where the trees are generated and kept between runs')
+    pipeline.add_argument('--output', default='benchmark.json')
+    pipeline.set_defaults(run=benchmark_pipeline)
+    compare = subparsers.add_parser('compare', help='compare two pipeline reports')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.set_defaults(run=compare_reports)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""Run the file_hasher engine from the command line, without a display or QtGui
+
+Progress is written to stderr as one JSON object per line, e.g. for cron jobs and monitoring. Files
+that can't be hashed are reported on stderr as plain lines starting with 'error', counted as
+files_failed in the progress, and make the exit status 1.
+
+    python -m file_hasher_cli /srv/artifacts hashes.txt --recursive --algorithm sha256 --cache
+"""
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import sys
+from PyQt5 import QtCore as qtc
+from file_hasher_engine import ALGORITHMS, DEFAULT_CHUNK_SIZE, HashCache, HashManager
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Hash, deduplicate or verify the files in a directory tree.')
+    parser.add_argument('source', nargs='?', default='',
+                        help='directory to hash; optional with --manifest, where it is checked for extra files')
+    parser.add_argument('destination', help='file the digests or the report are appended to')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count() or 2)
+    parser.add_argument('-a', '--algorithm', dest='algorithms', action='append', choices=ALGORITHMS,
+                        help='digest to compute, repeat for several in one pass (default: md5)')
+    parser.add_argument('-r', '--recursive', action='store_true')
+    parser.add_argument('--include', action='append', default=[], metavar='GLOB')
+    parser.add_argument('--exclude', action='append', default=[], metavar='GLOB')
+    parser.add_argument('--symlinks', choices=('skip', 'files', 'all'), default='skip')
+    parser.add_argument('--mode', choices=('hash', 'dedupe', 'manifest'), default='hash')
+    parser.add_argument('--manifest', help='path<tab>digests file to verify, implies --mode manifest; its digests '
+                                           "are those its '# algorithms:' line names, or else --algorithm's")
+    parser.add_argument('--backend', choices=('threads', 'processes'), default='threads')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE // 1024, metavar='KIB')
+    parser.add_argument('--read-strategy', choices=('auto', 'mmap', 'read'), default='auto',
+                        help='auto maps large local files with --backend processes only; mmap with threads '
+                             'crashes the whole run with a bus error if a file is truncated while being hashed')
+    parser.add_argument('--split-size', type=int, default=0, metavar='MIB',
+                        help='hash leaves of larger files in parallel, blake2b-tree only (default: never)')
+    parser.add_argument('--cache', nargs='?', const=HashCache.default_path, metavar='PATH',
+                        help=f'skip files unchanged since the last run (default path: {HashCache.default_path})')
+    parser.add_argument('--verify', action='store_true',
+                        help='re-read every file and report any that no longer match the cache')
+    parser.add_argument('--forget', action='append', default=[], metavar='PATH',
+                        help='drop the cached digests of PATH and the files below it before starting, implies --cache')
+    parser.add_argument('--progress', choices=('json', 'none'), default='json')
+    parser.add_argument('--progress-interval', type=float, default=HashManager.progress_interval, metavar='SECONDS')
+    args = parser.parse_args(argv)
+    if args.manifest:
+        args.mode = 'manifest'
+    if args.mode == 'manifest' and not args.manifest:
+        parser.error('--mode manifest needs --manifest')
+    if args.mode != 'manifest' and not args.source:
+        parser.error('the source directory is required')
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.chunk_size < 1:
+        parser.error('--chunk-size must be at least 1 KiB')
+    if args.source and not os.path.isdir(args.source):
+        parser.error(f'the source {args.source} is not a directory')
+    if args.source and not os.access(args.source, os.R_OK | os.X_OK):
+        parser.error(f'the source {args.source} is not readable')
+    if (args.verify or args.forget) and not args.cache:
+        args.cache = HashCache.default_path
+    return args
+
+
+def report_progress(progress):
+    sys.stderr.write(json.dumps(progress) + '\n')
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    app = qtc.QCoreApplication(sys.argv[:1])
+    manager = HashManager()
+    manager.progress_interval = args.progress_interval
+    if args.progress == 'json':
+        # The job runs on this thread, so progress has to be handled on whichever thread sends it
+        manager.progress.connect(report_progress, qtc.Qt.DirectConnection)
+    signal.signal(signal.SIGINT, lambda *_: manager.cancel())
+    signal.signal(signal.SIGTERM, lambda *_: manager.cancel())
+    if args.forget:
+        try:
+            cache = HashCache(args.cache)
+            for path in args.forget:
+                # The cache holds absolute paths, as the engine hashes below os.path.abspath(source)
+                cache.invalidate(os.path.abspath(path))
+            cache.close()
+        except (OSError, sqlite3.Error) as error:
+            print(f'cannot open the cache {args.cache}: {error}', file=sys.stderr)
+            return 1
+    options = {
+        'mode': args.mode,
+        'manifest': args.manifest,
+        'chunk_size': args.chunk_size * 1024,
+        'read_strategy': args.read_strategy,
+        'algorithms': args.algorithms or ['md5'],
+        'backend': args.backend,
+        'split_size': args.split_size * 1024 * 1024,
+        'recursive': args.recursive,
+        'include': args.include,
+        'exclude': args.exclude,
+        'symlinks': args.symlinks,
+        'cache': args.cache,
+        'verify': args.verify,
+    }
+    manager.do_hashing(args.source, args.destination, args.threads, options)
+    del app
+    if manager.summary.get('error'):
+        return 1
+    if manager.job.cancelled:
+        return 130
+    if any(manager.summary.get(status) for status in ('mismatched', 'missing', 'malformed', 'failed')):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1048 @@
+"""Hashing engine for file_hasher, kept apart from the GUI so it runs without QtGui and a display"""
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fnmatch import fnmatch
+from functools import lru_cache, partial
+from stat import S_ISREG
+from PyQt5 import QtCore as qtc
+from sqlite_paths import glob_escape, storable
+
+
+class Crc32:
+    """zlib.crc32 behind the hashlib update/hexdigest interface"""
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+TREE_LEAF_SIZE = 64 * 1024 * 1024
+
+
+def tree_node(node_offset=0, node_depth=0, last_node=False):
+    return hashlib.blake2b(fanout=0, depth=2, leaf_size=TREE_LEAF_SIZE, node_offset=node_offset,
+                           node_depth=node_depth, inner_size=64, last_node=last_node)
+
+
+def tree_root(leaf_digests):
+    root = tree_node(node_depth=1, last_node=True)
+    for digest in leaf_digests:
+        root.update(digest)
+    return root.hexdigest()
+
+
+class Blake2bTree:
+    """Two level BLAKE2b tree over TREE_LEAF_SIZE leaves
+
+    Gives the same digest whether the file is read front to back, or its leaves are hashed in parallel
+    with hash_leaf and combined with tree_root.
+    """
+
+    def __init__(self):
+        self.leaves = []
+        self.leaf = tree_node()
+        self.leaf_fill = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while data:
+            if self.leaf_fill == TREE_LEAF_SIZE:
+                self.leaves.append(self.leaf.digest())
+                self.leaf = tree_node(len(self.leaves))
+                self.leaf_fill = 0
+            size = min(len(data), TREE_LEAF_SIZE - self.leaf_fill)
+            self.leaf.update(data[:size])
+            self.leaf_fill += size
+            data = data[size:]
+
+    def hexdigest(self):
+        return tree_root(self.leaves + [self.leaf.digest()])
+
+
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+    'blake2b-tree': Blake2bTree,
+    'crc32': Crc32,
+}
+
+try:
+    import xxhash
+    ALGORITHMS['xxh64'] = xxhash.xxh64
+except ImportError:
+    pass
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+ALGORITHMS_HEADER = '# algorithms: '   # Starts the line naming the digests that follow each path in a digest file
+DEDUPE_PROBE_SIZE = 64 * 1024
+MMAP_THRESHOLD = 4 * 1024 * 1024    # Below this buffered reads win, see file_hasher_benchmark.py
+PROGRESS_CHUNKS = 16                # A running task adds what it has hashed to HashJob.in_progress this often
+NETWORK_FILESYSTEMS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'sshfs', 'ceph', 'glusterfs', 'lustre', '9p'}
+
+
+def iter_files(root, recursive=False, include=(), exclude=(), symlinks='skip'):
+    """Yield file paths below root as they are discovered
+
+    Directories are walked iteratively with os.scandir, so the first paths are yielded straight away
+    and the directory entry cache spares most stat calls. Exclude patterns also prune directories.
+    symlinks is 'skip', 'files' (follow links to files only) or 'all'.
+    """
+    def matches(patterns, entry):
+        relpath = os.path.relpath(entry.path, root)
+        return any(fnmatch(entry.name, pattern) or fnmatch(relpath, pattern) for pattern in patterns)
+
+    stack = [root]
+    root_stat = os.stat(root)
+    seen = {(root_stat.st_dev, root_stat.st_ino)}   # Guards against symlink loops when following directory links
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                if exclude and matches(exclude, entry):
+                    continue
+                try:
+                    is_link = entry.is_symlink()
+                    if entry.is_dir(follow_symlinks=symlinks == 'all'):
+                        if not recursive or (is_link and symlinks != 'all'):
+                            continue
+                        if is_link:
+                            target = entry.stat()
+                            inode = (target.st_dev, target.st_ino)
+                            if inode in seen:
+                                continue
+                            seen.add(inode)
+                        subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=symlinks != 'skip'):
+                        if include and not matches(include, entry):
+                            continue
+                        yield entry.path
+                except OSError:
+                    continue
+        stack.extend(reversed(subdirs))
+
+
+class HashCache:
+    """SQLite store of previous digests, valid while a file's size, mtime and inode are unchanged
+
+    Files whose paths SQLite can't store are never cached, they are hashed every time.
+    """
+
+    default_path = os.path.join(os.path.expanduser('~'), '.cache', 'file_hasher.sqlite3')
+
+    def __init__(self, path=default_path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = self.connect()    # Connections can't be shared between threads, this one is for lookups
+
+    def connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')   # Lets lookups proceed while the writer thread stores results
+        db.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT, algorithm TEXT, size INTEGER, mtime INTEGER, '
+                   'inode INTEGER, digest TEXT, PRIMARY KEY (path, algorithm))')
+        return db
+
+    @staticmethod
+    def key(stat):
+        return stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def lookup(self, path, algorithms, key):
+        """Return cached {algorithm: digest} for path, or None if any is missing or the file has changed since"""
+        if not storable(path):
+            return None
+        rows = self.db.execute('SELECT algorithm, size, mtime, inode, digest FROM hashes WHERE path = ?', (path,))
+        digests = {algorithm: digest for algorithm, *row_key, digest in rows if tuple(row_key) == tuple(key)}
+        if all(algorithm in digests for algorithm in algorithms):
+            return {algorithm: digests[algorithm] for algorithm in algorithms}
+        return None
+
+    @staticmethod
+    def store(db, rows):
+        rows = [row for row in rows if storable(row[0])]
+        db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)', rows)
+        db.commit()
+
+    def invalidate(self, path=''):
+        """Forget the cached digests of path and every file below it, or of every file if path is empty
+
+        Only whole path components match, forgetting /data/a leaves /data/ab alone.
+        """
+        if not path:
+            self.db.execute('DELETE FROM hashes')
+        elif storable(path):
+            below = glob_escape(path.rstrip(os.sep) + os.sep) + '*'
+            self.db.execute('DELETE FROM hashes WHERE path = ? OR path GLOB ?', (path, below))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class HashWriter:
+    """Owns the destination file for a job; runners queue results and one thread writes them in batches
+
+    With digests=False the digests only go to the cache, and the file just gets the write_line() reports.
+    The file is opened by the constructor, so a bad destination fails on the caller's thread; an error
+    writing it later is kept and raised again by close().
+    """
+
+    batch_size = 4096
+
+    def __init__(self, outfile, cache=None, digests=True):
+        self.results = queue.SimpleQueue()
+        self.cache = cache
+        self.digests = digests
+        self.error = None
+        # Paths that aren't valid UTF-8 are written back as the bytes they were read as
+        self.out = open(outfile, 'a', encoding='utf-8', errors='surrogateescape')
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def write(self, path, digests, cache_key=None):
+        """Queue {algorithm: digest} for path; cache_key is (size, mtime, inode) for freshly computed digests"""
+        line = f'{path}\t' + '\t'.join(digests.values()) + '\n' if self.digests else ''
+        self.results.put((line, path, digests, cache_key))
+
+    def write_line(self, line):
+        self.results.put((line + '\n', None, None, None))
+
+    def close(self):
+        self.results.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+    def _write(self):
+        db = None
+        try:
+            with self.out as out:
+                db = self.cache.connect() if self.cache else None
+                while True:
+                    batch = [self.results.get()]
+                    while len(batch) < self.batch_size and not self.results.empty():
+                        batch.append(self.results.get())
+                    done = batch[-1] is None
+                    if done:
+                        batch.pop()
+                    out.writelines(line for line, *_ in batch)
+                    out.flush()
+                    if db:
+                        self.cache.store(db, [(path, algorithm, *key, digest) for _, path, digests, key in batch
+                                              if key for algorithm, digest in digests.items()])
+                    if done:
+                        break
+        except Exception as error:
+            # Anything else would end the thread silently, and close() would report the job as a success
+            self.error = error
+            # Runners keep queueing results until the job ends, they are dropped rather than left to pile up
+            while self.results.get() is not None:
+                pass
+        finally:
+            if db:
+                db.close()
+
+
+class HashCancelled(Exception):
+    pass
+
+
+class HashJob:
+    """Pause, resume and cancel a running job from any thread
+
+    The state lives in shared memory so process pool workers see it too, they check it between chunks.
+    Workers also count the bytes hashed by tasks that haven't finished yet in in_progress.
+    """
+
+    RUNNING, PAUSED, CANCELLED = range(3)
+
+    def __init__(self, context=multiprocessing):
+        self.control = context.RawValue('i', self.RUNNING)
+        self.in_progress = context.Value('q', 0)
+
+    def pause(self):
+        if self.control.value == self.RUNNING:
+            self.control.value = self.PAUSED
+
+    def resume(self):
+        if self.control.value == self.PAUSED:
+            self.control.value = self.RUNNING
+
+    def cancel(self):
+        self.control.value = self.CANCELLED
+
+    @property
+    def paused(self):
+        return self.control.value == self.PAUSED
+
+    @property
+    def cancelled(self):
+        return self.control.value == self.CANCELLED
+
+
+def check_control(control):
+    """Block while the job is paused, raise HashCancelled once it has been cancelled"""
+    if control is None:
+        return
+    while control.value == HashJob.PAUSED:
+        time.sleep(0.1)
+    if control.value == HashJob.CANCELLED:
+        raise HashCancelled()
+
+
+_buffers = threading.local()   # One read buffer per worker thread (or process), reused for every file it hashes
+_worker_control = None          # HashJob.control of the job a process pool worker was started for
+_worker_in_progress = None      # And its HashJob.in_progress
+
+
+def init_worker(control, in_progress):
+    global _worker_control, _worker_in_progress
+    _worker_control = control
+    _worker_in_progress = in_progress
+
+
+class TaskProgress:
+    """Adds the bytes a task hashes to a shared counter every PROGRESS_CHUNKS chunks, until the task ends
+
+    On leaving the with block everything added is taken off again, as HashProgress.task_done then counts
+    the whole task. Without a counter it does nothing.
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.chunks = self.pending = self.added = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.add_to_counter(-self.added)
+
+    def add(self, size):
+        self.chunks += 1
+        self.pending += size
+        if self.chunks % PROGRESS_CHUNKS == 0:
+            self.add_to_counter(self.pending)
+            self.added += self.pending
+            self.pending = 0
+
+    def add_to_counter(self, size):
+        if self.counter is not None and size:
+            with self.counter.get_lock():
+                self.counter.value += size
+
+
+def get_buffer(chunk_size):
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != chunk_size:
+        buffer = _buffers.buffer = bytearray(chunk_size)
+    return buffer
+
+
+@lru_cache(maxsize=None)
+def digest_length(algorithm):
+    return len(ALGORITHMS[algorithm]().hexdigest())
+
+
+@lru_cache(maxsize=None)
+def network_mounts():
+    """Mount points of network filesystems, where mmap gains nothing and a vanishing server means SIGBUS"""
+    try:
+        with open('/proc/self/mountinfo', encoding='utf-8') as fh:
+            mounts = [line.split(' - ') for line in fh]
+    except OSError:
+        return ()
+    # Fields before the separator are "id parent dev root mountpoint ...", after it "fstype source ..."
+    return tuple(before.split()[4].replace('\\040', ' ') for before, after in mounts
+                 if after.split()[0].split('.')[-1] in NETWORK_FILESYSTEMS)
+
+
+def choose_strategy(fh, strategy='auto'):
+    """Return 'mmap' or 'read' for the open file fh, picking for it when strategy is 'auto'"""
+    stat = os.fstat(fh.fileno())
+    if not stat.st_size or not S_ISREG(stat.st_mode):
+        return 'read'
+    if strategy != 'auto':
+        return strategy
+    if stat.st_size < MMAP_THRESHOLD:
+        return 'read'
+    path = os.path.abspath(fh.name)
+    if any(path == mount or path.startswith(mount.rstrip('/') + '/') for mount in network_mounts()):
+        return 'read'
+    return 'mmap'
+
+
+def hash_file(path, algorithms=('md5',), chunk_size=DEFAULT_CHUNK_SIZE, strategy='auto', control=None,
+              in_progress=None):
+    """Return {algorithm: hex digest} for path, computing every digest from a single read of the file
+
+    strategy is 'read', 'mmap' or 'auto', which maps regular local files of at least MMAP_THRESHOLD bytes.
+    """
+    check_control(control)
+    hashers = [ALGORITHMS[algorithm]() for algorithm in algorithms]
+    with open(path, 'rb', buffering=0) as fh, TaskProgress(in_progress) as progress:
+        if choose_strategy(fh, strategy) == 'mmap':
+            # The hashers read straight from the page cache, there's no copy into a buffer at all.
+            # Reading happens as page faults inside update(), so it can't be timed separately
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(view), chunk_size):
+                        check_control(control)
+                        chunk = view[offset:offset + chunk_size]
+                        for hasher in hashers:
+                            hasher.update(chunk)
+                        progress.add(len(chunk))
+                        chunk.release()
+        else:
+            # Stream the file through a fixed-size buffer so memory use doesn't depend on file size
+            buffer = get_buffer(chunk_size)
+            view = memoryview(buffer)
+            while True:
+                check_control(control)
+                started = time.perf_counter()
+                size = fh.readinto(buffer)
+                _buffers.io_time = getattr(_buffers, 'io_time', 0.0) + time.perf_counter() - started
+                if not size:
+                    break
+                chunk = view[:size]
+                for hasher in hashers:
+                    hasher.update(chunk)
+                progress.add(size)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in zip(algorithms, hashers)}
+
+
+def hash_leaf(path, index, chunk_size=DEFAULT_CHUNK_SIZE, control=None, in_progress=None):
+    """Return the blake2b-tree digest of leaf number index of path"""
+    check_control(control)
+    hasher = tree_node(index)
+    buffer = get_buffer(chunk_size)
+    view = memoryview(buffer)
+    remaining = TREE_LEAF_SIZE
+    with open(path, 'rb', buffering=0) as fh, TaskProgress(in_progress) as progress:
+        fh.seek(index * TREE_LEAF_SIZE)
+        while remaining:
+            check_control(control)
+            started = time.perf_counter()
+            size = fh.readinto(view[:min(remaining, chunk_size)])
+            _buffers.io_time = getattr(_buffers, 'io_time', 0.0) + time.perf_counter() - started
+            if not size:
+                break
+            hasher.update(view[:size])
+            progress.add(size)
+            remaining -= size
+    return hasher.digest()
+
+
+def hash_ends(path, size, chunk_size=DEFAULT_CHUNK_SIZE, control=None, in_progress=None):
+    """Return a blake2b digest of the first and last DEDUPE_PROBE_SIZE bytes of path, or all of it if it's small
+
+    in_progress is ignored, the probe is over before it would be worth reporting.
+    """
+    check_control(control)
+    hasher = hashlib.blake2b()
+    started = time.perf_counter()
+    with open(path, 'rb') as fh:
+        if size <= 2 * DEDUPE_PROBE_SIZE:
+            hasher.update(fh.read())
+        else:
+            hasher.update(fh.read(DEDUPE_PROBE_SIZE))
+            fh.seek(-DEDUPE_PROBE_SIZE, os.SEEK_END)
+            hasher.update(fh.read(DEDUPE_PROBE_SIZE))
+    _buffers.io_time = getattr(_buffers, 'io_time', 0.0) + time.perf_counter() - started
+    return hasher.hexdigest()
+
+
+def run_task(function, args, control=None, in_progress=None):
+    """Run function(*args) in a worker, returning (result, worker name, busy seconds, seconds spent reading)"""
+    _buffers.io_time = 0.0
+    started = time.perf_counter()
+    result = function(*args, control=control if control is not None else _worker_control,
+                      in_progress=in_progress if in_progress is not None else _worker_in_progress)
+    return result, f'{os.getpid()}/{threading.get_native_id()}', time.perf_counter() - started, _buffers.io_time
+
+
+class HashProgress:
+    """Thread-safe counters for a hashing job, summarised by snapshot() for the progress signal
+
+    in_progress is the job's count of bytes hashed by unfinished tasks, so one huge file shows progress too.
+    """
+
+    def __init__(self, in_progress=None):
+        self.in_progress = in_progress
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.walking = True
+        self.files_found = self.files_done = self.files_cached = self.files_failed = 0
+        self.bytes_found = self.bytes_done = 0
+        self.io_time = 0.0
+        self.busy = {}      # Worker name: seconds spent running tasks
+
+    def found(self, size):
+        with self.lock:
+            self.files_found += 1
+            self.bytes_found += size
+
+    def cached(self):
+        with self.lock:
+            self.files_found += 1
+            self.files_cached += 1
+
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+
+    def failed(self, message):
+        """Count a file that couldn't be hashed, reporting why on stderr"""
+        with self.lock:
+            self.files_failed += 1
+        print(message, file=sys.stderr)
+
+    def task_done(self, size, worker, busy, io_time):
+        with self.lock:
+            self.bytes_done += size
+            self.busy[worker] = self.busy.get(worker, 0.0) + busy
+            self.io_time += io_time
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.perf_counter() - self.started, 1e-9)
+            bytes_done = self.bytes_done + (self.in_progress.value if self.in_progress is not None else 0)
+            rate = bytes_done / elapsed
+            busy = sum(self.busy.values())
+            remaining = self.bytes_found - bytes_done
+            return {
+                'files_done': self.files_done,
+                'files_found': self.files_found,
+                'files_cached': self.files_cached,
+                'files_failed': self.files_failed,
+                'bytes_done': bytes_done,
+                'bytes_found': self.bytes_found,
+                'walking': self.walking,
+                'elapsed': elapsed,
+                'rate': rate,
+                'eta': remaining / rate if rate and not self.walking else None,
+                'utilisation': {worker: min(time_ / elapsed, 1.0) for worker, time_ in self.busy.items()},
+                'io_fraction': self.io_time / busy if busy else 0.0,
+            }
+
+
+class TreeHashJob:
+    """Collects the leaf digests of a file split across workers and reports the root once all are in"""
+
+    def __init__(self, path, leaf_count, on_complete, on_failed):
+        self.path = path
+        self.leaves = [None] * leaf_count
+        self.remaining = leaf_count
+        self.failed = False
+        self.lock = threading.Lock()
+        self.on_complete = on_complete
+        self.on_failed = on_failed
+
+    def add(self, index, digest, error):
+        with self.lock:
+            if error:
+                if not self.failed and not isinstance(error, HashCancelled):
+                    self.on_failed(f'error hashing {self.path}: {error}')
+                self.failed = True
+            self.leaves[index] = digest
+            self.remaining -= 1
+            complete = not self.remaining and not self.failed
+        if complete:
+            self.on_complete({'blake2b-tree': tree_root(self.leaves)})
+
+
+class DuplicateFinder:
+    """Finds groups of identical files with a HashManager, reading as little of each file as it can
+
+    Files can only match if their sizes do, so the whole tree is stat'ed and grouped by size first.
+    Same-size files are then compared by their first and last DEDUPE_PROBE_SIZE bytes, and only those
+    still matching are hashed in full. Hard links to one inode are read once, and reported as a group
+    of their own as well as with any other files they match.
+    """
+
+    def __init__(self, manager, cache, verify, algorithms, chunk_size, split_size):
+        self.manager = manager
+        self.cache = cache
+        self.verify = verify
+        self.algorithms = algorithms
+        self.chunk_size = chunk_size
+        self.split_size = split_size
+        self.lock = threading.Lock()
+        self.links = {}     # Path read for an inode: every path of that inode
+        self.sizes = {}     # Path read for an inode: its size when the tree was walked
+        self.groups = {}    # Matching key (size, digest): paths read
+        self.final = []     # (key, paths) known to match without reading, kept out of the full-hash round
+
+    def add(self, key, path, digest=None, error=None):
+        if error:
+            if not isinstance(error, HashCancelled):
+                self.manager.stats.failed(f'error hashing {path}: {error}')
+            return
+        with self.lock:
+            self.groups.setdefault((key, digest), []).append(path)
+
+    def on_probe_done(self, size, path, digest, error):
+        self.manager.stats.file_done()
+        self.add(size, path, f'blake2b {digest}', error)
+
+    def on_hashed(self, path, digests, cache_key=None, expected=None):
+        self.manager.on_result(path, digests, cache_key, expected)
+        self.add(self.sizes[path], path, tuple(digests.items()))
+
+    def take_matches(self):
+        """Return the lists of paths that still share a key, and start afresh for the next round"""
+        groups, self.groups = self.groups, {}
+        return [(key, paths) for key, paths in groups.items() if len(paths) > 1]
+
+    def probe_tasks(self, by_size):
+        for size, stats in by_size.items():
+            inodes = {}
+            for path, stat in stats:
+                inodes.setdefault((stat.st_dev, stat.st_ino), []).append(path)
+            for paths in inodes.values():
+                self.links[paths[0]] = paths
+                self.sizes[paths[0]] = size
+                if len(paths) > 1:
+                    # Nothing to read, they are all the same data; the inode may still match others below
+                    self.final.append(((size, 'hard links'), [paths[0]]))
+            if len(inodes) == 1:
+                continue
+            if size == 0:
+                self.final.append(((size, 'empty'), [paths[0] for paths in inodes.values()]))
+                continue
+            for paths in inodes.values():
+                probe_size = min(size, 2 * DEDUPE_PROBE_SIZE)
+                self.manager.stats.found(probe_size)
+                yield [(probe_size, hash_ends, (paths[0], size, self.chunk_size),
+                        partial(self.on_probe_done, size, paths[0]))]
+
+    def run(self, files):
+        by_size = {}
+        for filepath in files:
+            self.manager.wait_while_paused()
+            if self.manager.job.cancelled:
+                return
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            by_size.setdefault(stat.st_size, []).append((filepath, stat))
+        self.manager.run_tasks(self.probe_tasks({size: stats for size, stats in by_size.items() if len(stats) > 1}))
+        # Files no bigger than both probes together were read completely, so their matches are final
+        matches = self.take_matches()
+        duplicates = self.final + [(key, paths) for key, paths in matches if key[0] <= 2 * DEDUPE_PROBE_SIZE]
+        self.manager.run_tasks(self.manager.hash_tasks(
+            (path for key, paths in matches if key[0] > 2 * DEDUPE_PROBE_SIZE for path in paths), self.cache,
+            self.verify, self.algorithms, self.chunk_size, self.split_size, self.on_hashed))
+        duplicates += self.take_matches()
+        if self.manager.job.cancelled:
+            return
+        for (size, digest), paths in sorted(duplicates, key=lambda group: -group[0][0]):
+            paths = [link for path in paths for link in self.links.get(path, [path])]
+            if isinstance(digest, tuple):
+                digest = ' '.join(f'{algorithm} {value}' for algorithm, value in digest)
+            self.manager.writer.write_line(f'# {len(paths)} files of {size} bytes, {digest}')
+            for path in paths:
+                self.manager.writer.write_line(path)
+            self.manager.writer.write_line('')
+
+
+class ManifestVerifier:
+    """Re-hashes the files listed in a path<tab>digests manifest and reports the ones that don't match
+
+    The digests on each line are those named by the last ALGORITHMS_HEADER line before it, as hash mode
+    writes them, or the job's algorithms if there is none. Lines whose digests don't fit are malformed.
+    The manifest is streamed, its paths go to a temporary SQLite table rather than memory so files in
+    the source tree that it doesn't list can be reported as extra afterwards.
+    """
+
+    def __init__(self, manager, cache, verify, algorithms, chunk_size, split_size):
+        self.manager = manager
+        self.cache = cache
+        self.verify = verify
+        self.algorithms = algorithms
+        self.chunk_size = chunk_size
+        self.split_size = split_size
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(('ok', 'mismatched', 'missing', 'extra', 'malformed'), 0)
+        self.listed = sqlite3.connect('')   # An empty name gives a temporary database on disk
+        # Paths as bytes, so ones that aren't valid UTF-8 can be stored too
+        self.listed.execute('CREATE TABLE listed (path BLOB PRIMARY KEY)')
+
+    def report(self, status, *fields):
+        with self.lock:
+            self.counts[status] += 1
+        if status != 'ok':
+            self.manager.writer.write_line('\t'.join((status.upper(), *fields)))
+
+    def on_hashed(self, path, digests, cache_key=None, expected=None):
+        self.manager.on_result(path, digests, cache_key)
+        if digests == expected:
+            self.report('ok', path)
+        else:
+            self.report('mismatched', path, ' '.join(expected.values()), ' '.join(digests.values()))
+
+    def read_manifest(self, manifest):
+        """Yield (absolute path, {algorithm: expected digest}) for each line of manifest"""
+        base = os.path.dirname(os.path.abspath(manifest))
+        algorithms = self.algorithms
+        # Undecodable bytes come back as they were written, see HashWriter
+        with open(manifest, encoding='utf-8', errors='surrogateescape') as fh:
+            for number, line in enumerate(fh, 1):
+                line = line.rstrip('\n')
+                if line.startswith(ALGORITHMS_HEADER):
+                    algorithms = line[len(ALGORITHMS_HEADER):].split()
+                    if not algorithms or any(algorithm not in ALGORITHMS for algorithm in algorithms):
+                        self.report('malformed', f'{manifest}:{number}')
+                        algorithms = []     # The lines it applies to can't be checked either
+                    continue
+                if not line or line.startswith('#'):
+                    continue
+                path, *digests = line.rsplit('\t', len(algorithms))
+                if (not algorithms or len(digests) != len(algorithms) or
+                        any(len(digest) != digest_length(algorithm) for algorithm, digest in zip(algorithms, digests))):
+                    self.report('malformed', f'{manifest}:{number}')
+                    continue
+                # Normalised like the walked paths, so ./sub/f isn't also reported as an extra file
+                yield os.path.normpath(os.path.join(base, path)), dict(zip(algorithms, digests))
+
+    def tasks(self, manifest):
+        stats = self.manager.stats
+        batch = []
+        for path, expected in self.read_manifest(manifest):
+            algorithms = list(expected)
+            batch.append((os.fsencode(path),))
+            if len(batch) >= 10000:
+                self.listed.executemany('INSERT OR IGNORE INTO listed VALUES (?)', batch)
+                batch.clear()
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.report('missing', path)
+                yield []
+                continue
+            cache_key = None
+            if self.cache:
+                cache_key = self.cache.key(stat)
+                cached = self.cache.lookup(path, algorithms, cache_key)
+                if cached and not self.verify:
+                    stats.cached()
+                    self.on_hashed(path, cached, expected=expected)
+                    yield []
+                    continue
+            stats.found(stat.st_size)
+            yield self.manager.make_tasks(path, stat.st_size, algorithms, self.chunk_size, self.split_size,
+                                          cache_key, expected, self.on_hashed)
+        self.listed.executemany('INSERT OR IGNORE INTO listed VALUES (?)', batch)
+
+    def run(self, manifest, files=()):
+        """Check the files listed in manifest, then report any of files that it doesn't list"""
+        self.manager.run_tasks(self.tasks(manifest))
+        for path in files:
+            if self.manager.job.cancelled:
+                break
+            if not self.listed.execute('SELECT 1 FROM listed WHERE path = ?', (os.fsencode(path),)).fetchone():
+                self.report('extra', path)
+        self.listed.close()
+        self.manager.writer.write_line('# ' + ', '.join(f'{count} {status}' for status, count in self.counts.items()))
+
+
+class HashRunner(qtc.QRunnable):
+    """Runs one hashing function on the thread pool and hands the result, or the error, to on_done"""
+
+    def __init__(self, function, args, on_done):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.setAutoDelete(True)        # Objects will be deleted after run
+
+    def run(self):
+        try:
+            result = self.function(*self.args)
+        except Exception as error:
+            self.on_done(None, error)
+        else:
+            self.on_done(result, None)
+
+
+class HashManager(qtc.QObject):
+
+    finished = qtc.pyqtSignal()
+    file_hashed = qtc.pyqtSignal(str, dict)     # Emitted from worker threads, so receivers get it queued
+    progress = qtc.pyqtSignal(dict)             # HashProgress.snapshot(), at most every progress_interval
+
+    progress_interval = 0.5
+    max_pending = 100000
+
+    def __init__(self):
+        super().__init__()
+        self.pool = qtc.QThreadPool.globalInstance()
+        self.writer = None
+        self.executor = None
+        self.slots = None
+        self.slot_count = 0
+        self.stats = None
+        self.job = None
+        self.read_strategy = 'auto'
+        # Status counts from the last job: a manifest's, or files that failed --verify, and any error that ended it
+        self.summary = None
+        self.last_progress = 0.0
+
+    # These are called straight from the GUI thread, as this object's thread is busy running the job
+    def pause(self):
+        if self.job:
+            self.job.pause()
+
+    def resume(self):
+        if self.job:
+            self.job.resume()
+
+    def cancel(self):
+        if self.job:
+            self.job.cancel()
+
+    def emit_progress(self, force=False):
+        now = time.perf_counter()
+        with self.stats.lock:
+            if not force and now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+        self.progress.emit(self.stats.snapshot())
+
+    def on_result(self, path, digests, cache_key=None, expected=None):
+        if expected and expected != digests:
+            with self.stats.lock:
+                self.summary['mismatched'] += 1
+            # A comment line, so a digest file stays usable as a manifest
+            self.writer.write_line('\t'.join(('# MISMATCHED', path, ' '.join(expected.values()),
+                                              ' '.join(digests.values()))))
+        self.writer.write(path, digests, cache_key)
+        self.stats.file_done()
+        self.file_hashed.emit(path, digests)
+
+    def report_error(self, message):
+        """Record an error that spoils the whole job, such as the destination not being writable"""
+        self.summary['error'] = message
+        print(message, file=sys.stderr)
+
+    def on_file_done(self, on_result, path, cache_key, expected, digests, error):
+        if isinstance(error, HashCancelled):
+            return
+        if error:
+            self.stats.failed(f'error hashing {path}: {error}')
+        else:
+            on_result(path, digests, cache_key, expected)
+
+    def on_task_done(self, size, on_done, result, error):
+        try:
+            if error:
+                on_done(None, error)
+            else:
+                result, worker, busy, io_time = result
+                self.stats.task_done(size, worker, busy, io_time)
+                on_done(result, None)
+        except Exception as callback_error:
+            # A slot that's never released leaves run_tasks waiting forever, cancel() can't break that
+            self.stats.failed(f'error handling a hashing result: {callback_error!r}')
+        finally:
+            self.slots.release()
+        self.emit_progress()
+
+    def on_future_done(self, size, on_done, future):
+        error = future.exception()      # OSError from the worker, or BrokenProcessPool if it died
+        self.on_task_done(size, on_done, None if error else future.result(), error)
+
+    def submit(self, size, function, args, on_done):
+        """Start a task on the active backend, the caller must already hold one of self.slots"""
+        if self.executor:
+            future = self.executor.submit(run_task, function, args)
+            future.add_done_callback(partial(self.on_future_done, size, on_done))
+        else:
+            self.pool.start(HashRunner(run_task, (function, args, self.job.control, self.job.in_progress),
+                                       partial(self.on_task_done, size, on_done)))
+
+    def acquire_slot(self):
+        """Wait for a free slot and return True, or return False if the job is cancelled meanwhile"""
+        while not self.slots.acquire(timeout=max(self.progress_interval, 0.05)):
+            if self.job.cancelled:
+                return False
+            self.emit_progress()
+        return True
+
+    def wait_while_paused(self):
+        while self.job.paused:
+            time.sleep(0.1)
+            self.emit_progress()
+
+    def make_tasks(self, path, size, algorithms, chunk_size, split_size, cache_key, expected, on_result=None):
+        """Return (size, function, args, on_done) tasks that hash path, one per leaf if it gets split"""
+        on_result = on_result or self.on_result
+        if split_size and size > split_size and list(algorithms) == ['blake2b-tree']:
+            leaf_count = -(-size // TREE_LEAF_SIZE)
+            job = TreeHashJob(path, leaf_count, partial(on_result, path, cache_key=cache_key, expected=expected),
+                              self.stats.failed)
+            return [(min(TREE_LEAF_SIZE, size - index * TREE_LEAF_SIZE), hash_leaf, (path, index, chunk_size),
+                     partial(job.add, index)) for index in range(leaf_count)]
+        return [(size, hash_file, (path, algorithms, chunk_size, self.read_strategy),
+                 partial(self.on_file_done, on_result, path, cache_key, expected))]
+
+    def hash_tasks(self, files, cache, verify, algorithms, chunk_size, split_size, on_result=None):
+        """Yield the tasks for each file in files, answering unchanged ones from the cache instead"""
+        on_result = on_result or self.on_result
+        for filepath in files:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                continue
+            cache_key = cached = None
+            if cache:
+                cache_key = cache.key(stat)
+                cached = cache.lookup(filepath, algorithms, cache_key)
+                if cached and not verify:
+                    self.stats.cached()
+                    on_result(filepath, cached)
+                    yield []
+                    continue
+            self.stats.found(stat.st_size)
+            yield self.make_tasks(filepath, stat.st_size, algorithms, chunk_size, split_size, cache_key, cached,
+                                  on_result)
+
+    def run_tasks(self, batches):
+        """Run every task in the lists yielded by batches and return once they have all finished
+
+        Only a couple of tasks per worker are handed to the backend at a time. The rest wait in a heap
+        so whichever is largest goes next, instead of a big file found late holding up the end of the job.
+        """
+        pending = []
+        order = itertools.count()
+        for tasks in batches:
+            self.wait_while_paused()
+            if self.job.cancelled:
+                break
+            for task in tasks:
+                heapq.heappush(pending, (-task[0], next(order), task))
+            while pending and self.slots.acquire(blocking=False):
+                self.submit(*heapq.heappop(pending)[2])
+            if len(pending) >= self.max_pending:  # Stop reading ahead until a worker frees up
+                if not self.acquire_slot():
+                    break
+                self.submit(*heapq.heappop(pending)[2])
+            self.emit_progress()
+        self.stats.walking = False
+        while pending and not self.job.cancelled and self.acquire_slot():
+            self.submit(*heapq.heappop(pending)[2])
+        # Tasks already handed to the backend see the cancellation at their next chunk and return early
+        for _ in range(self.slot_count):    # Every slot is back once the last task has finished
+            while not self.slots.acquire(timeout=max(self.progress_interval, 0.05)):
+                self.emit_progress()
+        for _ in range(self.slot_count):
+            self.slots.release()
+
+    def start_job(self, threads, backend, writer):
+        self.writer = writer
+        # Spawn rather than fork, forking a process that is running Qt threads isn't safe
+        context = multiprocessing.get_context('spawn')
+        self.job = HashJob(context)
+        if backend == 'processes':
+            self.executor = ProcessPoolExecutor(threads, mp_context=context, initializer=init_worker,
+                                                initargs=(self.job.control, self.job.in_progress))
+        else:
+            self.pool.setMaxThreadCount(threads)
+        self.slot_count = threads * 2
+        self.slots = threading.Semaphore(self.slot_count)
+        self.stats = HashProgress(self.job.in_progress)
+
+    def finish_job(self):
+        self.emit_progress(force=True)
+        if self.executor:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        else:
+            self.pool.waitForDone()
+        self.writer.close()
+
+    @qtc.pyqtSlot(str, str, int, dict)
+    def do_hashing(self, source, destination, threads, options):
+        chunk_size = options.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        algorithms = options.get('algorithms', ['md5'])
+        split_size = options.get('split_size', 0)
+        files = iter_files(
+            os.path.abspath(source), options.get('recursive', False), options.get('include', ()),
+            options.get('exclude', ()), options.get('symlinks', 'skip')) if source else ()
+        verify = options.get('verify', False)
+        mode = options.get('mode', 'hash')
+        self.read_strategy = options.get('read_strategy', 'auto')
+        if self.read_strategy == 'auto' and options.get('backend') != 'processes':
+            # A mapped file truncated while it's hashed raises SIGBUS. In a pool worker that ends the job
+            # with BrokenProcessPool, on a thread it kills this whole process
+            self.read_strategy = 'read'
+        self.summary = {'mismatched': 0}
+        try:
+            cache = HashCache(options['cache']) if options.get('cache') else None
+        except (OSError, sqlite3.Error) as error:
+            # E.g. a read-only ~/.cache, or a directory given as the cache file
+            self.report_error(f'cannot open the cache {options["cache"]}: {error}')
+            self.finished.emit()
+            return
+        try:
+            # The other modes write reports, so the digests only go to the cache
+            writer = HashWriter(destination, cache, digests=mode == 'hash')
+        except OSError as error:
+            self.report_error(f'cannot open {destination}: {error}')
+            if cache:
+                cache.close()
+            self.finished.emit()
+            return
+        self.start_job(threads, options.get('backend'), writer)
+        if mode == 'hash':
+            writer.write_line(ALGORITHMS_HEADER + ' '.join(algorithms))     # So verifying needs no --algorithm
+        try:
+            if mode == 'dedupe':
+                DuplicateFinder(self, cache, verify, algorithms, chunk_size, split_size).run(files)
+            elif mode == 'manifest':
+                verifier = ManifestVerifier(self, cache, verify, algorithms, chunk_size, split_size)
+                verifier.run(options['manifest'], files)
+                self.summary.update(verifier.counts)
+            else:
+                self.run_tasks(self.hash_tasks(files, cache, verify, algorithms, chunk_size, split_size))
+        except OSError as error:
+            self.job.cancel()   # Whatever was already submitted only needs to wind down
+            self.report_error(f'error reading {error.filename or source}: {error}')
+        except BrokenProcessPool as error:
+            # A worker was killed, e.g. by the OOM killer or a SIGBUS from a mapped file that was truncated
+            self.job.cancel()
+            self.report_error(f'hashing worker died: {error}')
+        finally:
+            # The pool and writer are shut down and finished emitted even if the job body raised
+            try:
+                self.finish_job()
+            except Exception as error:     # The writer keeps whatever stopped it, not just I/O errors
+                self.report_error(f'error writing {destination}: {error}')
+            self.summary['failed'] = self.stats.files_failed
+            if cache:
+                cache.close()
+            self.finished.emit()
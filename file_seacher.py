@@ -1,82 +1,397 @@
+import collections
+import itertools
+import multiprocessing
+import os
+import re
 import sys
+import time
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
 from PyQt5 import QtWidgets as qtw
 from PyQt5 import QtGui as qtg
 from PyQt5 import QtCore as qtc
+from file_seacher_fuzzy import FuzzyRanking, ignores_case
+from file_seacher_grep import compile_pattern, grep_files
+from file_seacher_index import Indexer, PathIndex, PruneRules, root_device, scan_directory
 
 
 class SlowSearcher(qtc.QObject):
-    match_found = qtc.pyqtSignal(str)
-    directory_changed = qtc.pyqtSignal(str)
-    finished = qtc.pyqtSignal()
+    matches_found = qtc.pyqtSignal(int, list)   # (generation, batch of paths), at most every batch_interval
+    directory_changed = qtc.pyqtSignal(str)     # The latest directory listed, at most every batch_interval
+    finished = qtc.pyqtSignal(int, bool)        # (generation, False if it was cancelled)
 
+    # Directories are listed by a pool so slow (e.g. network) filesystems have several requests in flight
+    threads = 16
+    batch_interval = 0.05
+    # Content searches read files in a process pool, a batch of files per task
+    processes = os.cpu_count() or 1
+    grep_batch_size = 64
+    # Fuzzy searches score every candidate and send only the best, once the search is complete
+    fuzzy_limit = 1000
+    index_batch_size = 1000
+
+    def __init__(self, index=None):
+        super().__init__()
+        self.index = index
+        self.index_ready = False
+        self.index_rules = None     # What the index left out, searches that leave out less can't use it
+        self.generation = 0     # Bumped by cancel(), a search stops once it's no longer the latest
+        self.current = 0
+        self.batch = []
+        self.directory = None
+        self.last_flush = 0.0
+        self.executor = None
+        self.ranking = None
+        self.profile = None     # A ScanProfile to time every directory listed, opt-in as it costs a lock per listing
+
+    def use_index(self, rules):
+        self.index_rules = rules
+        self.index_ready = True
+
+    # Not a slot: do_search keeps this object's thread busy, so the form calls this directly to interrupt it
+    def cancel(self):
+        """Stop the running search at its next directory, returning the generation for the next one"""
+        self.generation += 1
+        return self.generation
+
+    def cancelled(self):
+        return self.current != self.generation
+
+    def grep_pool(self):
+        # Started on the first content search and kept, so later ones don't wait for processes to spawn
+        if not self.executor:
+            # Spawned, as a forked worker would inherit any locks the searcher's and indexer's threads were holding
+            self.executor = futures.ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def shutdown(self, wait=True):
+        if self.executor:
+            self.executor.shutdown(wait, cancel_futures=True)
+            self.executor = None
+
+    @qtc.pyqtSlot(str, int, dict)
+    def do_search(self, term, generation, options):
+        """Search for term below root (the filesystem root by default)
+
+        The other options are content (search file contents instead of paths), regex (for contents or
+        paths, taking precedence over fuzzy), fuzzy and rules.
+        """
+        if generation != self.generation:
+            return      # Superseded while it was queued
+        self.current = generation
+        self.batch = []
+        self.directory = None
+        regex = options.get('regex', False)
+        fuzzy = options.get('fuzzy') and not options.get('content') and not regex
+        self.ranking = FuzzyRanking(term, self.fuzzy_limit) if fuzzy else None
+        rules = options.get('rules') or PruneRules()
+        root = options.get('root') or qtc.QDir.rootPath()
+        # The index covers the filesystem root, and only what its rules kept; it can't match regexes
+        if (self.index and self.index_ready and root == qtc.QDir.rootPath() and not options.get('content')
+                and not regex and rules.narrows(self.index_rules)):
+            completed = self._search_index(term, root, rules)
+        else:
+            completed = self._search(term, root, rules, options.get('content', False), regex)
+        if self.ranking and completed:
+            self.batch = self.ranking.best()
+        self.ranking = None
+        self.flush(force=True)
+        self.finished.emit(generation, completed)
+
+    def flush(self, force=False):
+        """Send the matches and directory gathered since the last flush, if batch_interval has passed"""
+        now = time.perf_counter()
+        if not force and now - self.last_flush < self.batch_interval:
+            return
+        self.last_flush = now
+        if self.batch:
+            self.matches_found.emit(self.current, self.batch)
+            self.batch = []
+        if self.directory:
+            self.directory_changed.emit(self.directory)
+            self.directory = None
+
+    def _search_index(self, term, root, rules):
+        # The index holds what its own rules kept, these rules may leave out more
+        keep = (lambda path: True) if rules == self.index_rules else (lambda path: rules.keep_path(path, root))
+        db = self.index.connect()
+        try:
+            if self.ranking:
+                matches = self.index.search_subsequence(db, term, ignores_case(term))
+            else:
+                matches = self.index.search(db, term)
+            while paths := list(itertools.islice(matches, self.index_batch_size)):
+                if self.cancelled():
+                    return False
+                paths = [path for path in paths if keep(path)]
+                if self.ranking:
+                    self.ranking.add(paths)
+                else:
+                    self.batch.extend(paths)
+                self.flush()
+        finally:
+            db.close()
+        return True
+
+    def _search(self, term, root, rules, content=False, regex=False):
+        device = root_device(root, rules)
+        scan = self.profile.scan if self.profile else scan_directory
+        queue = collections.deque([(root, 0)])
+        files = collections.deque()
+        listings, greps = set(), set()
+        matches = re.compile(term).search if regex else lambda path: term in path
+        with futures.ThreadPoolExecutor(self.threads) as pool:
+            while queue or files or listings or greps:
+                if self.cancelled():
+                    for future in listings | greps:
+                        future.cancel()
+                    return False
+                # Keep a couple of listings per thread in flight, the rest wait in the queue
+                while queue and len(listings) < self.threads * 2:
+                    path, depth = queue.popleft()
+                    future = pool.submit(scan, path, rules, device)
+                    future.path, future.depth = path, depth
+                    listings.add(future)
+                # Whole batches of files to grep, and whatever is left once the listing is done
+                while files and len(greps) < self.processes * 2 and (
+                        len(files) >= self.grep_batch_size or not (queue or listings)):
+                    batch = [files.popleft() for _ in range(min(len(files), self.grep_batch_size))]
+                    try:
+                        greps.add(self.grep_pool().submit(grep_files, batch, term, regex))
+                    except BrokenProcessPool as error:
+                        # Dropped so the next search starts a new pool, rather than failing the same way
+                        print(f'Content search failed: {error!r}')
+                        self.shutdown(wait=False)
+                        for future in listings | greps:
+                            future.cancel()
+                        return False
+                # The timeout lets a batch go out even while a slow listing holds everything up
+                done, _ = futures.wait(listings | greps, self.batch_interval, futures.FIRST_COMPLETED)
+                for future in done:
+                    if future in listings:
+                        listings.remove(future)
+                        self.directory = future.path
+                        paths, subdirs, dir_files = future.result()
+                        if rules.descend(future.depth + 1):
+                            queue.extend((subdir, future.depth + 1) for subdir in subdirs)
+                        if content:
+                            files.extend(dir_files)
+                        elif self.ranking:
+                            self.ranking.add(paths)
+                        else:
+                            self.batch.extend(path for path in paths if matches(path))
+                    else:
+                        greps.remove(future)
+                        error = future.exception()      # BrokenProcessPool if a worker died
+                        if error:
+                            print(f'Content search failed: {error!r}')
+                            if isinstance(error, BrokenProcessPool):
+                                self.shutdown(wait=False)
+                        else:
+                            self.batch.extend(future.result())
+                self.flush()
+        return True
+
+
+class ResultsModel(qtc.QAbstractListModel):
+    """The search results, added a batch at a time so the view updates once per batch"""
     def __init__(self):
         super().__init__()
-        self.term = None
+        self._data = []
 
-    def set_term(self, term):
-        self.term = term
+    def rowCount(self, parent=qtc.QModelIndex()):
+        return 0 if parent.isValid() else len(self._data)
+
+    def data(self, index, role):
+        if role == qtc.Qt.DisplayRole:
+            return self._data[index.row()]
+
+    def add_results(self, results):
+        if results:
+            self.beginInsertRows(qtc.QModelIndex(), len(self._data), len(self._data) + len(results) - 1)
+            self._data.extend(results)
+            self.endInsertRows()
 
-    def do_search(self):
-        root = qtc.QDir.rootPath()
-        self._search(self.term, root)
-        self.finished.emit()
+    def clear(self):
+        self.beginResetModel()
+        self._data = []
+        self.endResetModel()
 
-    def _search(self, term, path):
-        self.directory_changed.emit(path)
-        directory = qtc.QDir(path)
-        directory.setFilter(directory.filter() | qtc.QDir.NoDotAndDotDot | qtc.QDir.NoSymLinks)
-        for entry in directory.entryInfoList():
-            if term in entry.filePath():
-                print(entry.filePath())
-                self.match_found.emit(entry.filePath())
-            if entry.isDir():
-                self._search(term, entry.filePath())
+    def filter(self, predicate):
+        self.beginResetModel()
+        self._data = [result for result in self._data if predicate(result)]
+        self.endResetModel()
 
 
 class SearchForm(qtw.QWidget):
     textChanged = qtc.pyqtSignal(str)
     returnPressed = qtc.pyqtSignal()
+    optionsChanged = qtc.pyqtSignal()
     def __init__(self):
         super().__init__()
         self.setLayout(qtw.QVBoxLayout())
         self.search_term_inp = qtw.QLineEdit(placeholderText='Search Term', textChanged=self.textChanged, returnPressed=self.returnPressed)
-        self.layout().addWidget(self.search_term_inp)
-        self.results = qtw.QListWidget()
-        self.layout().addWidget(self.results)
-        self.returnPressed.connect(self.results.clear)
+        self.content_check = qtw.QCheckBox('Contents', toolTip='Search inside files instead of their paths',
+                                           toggled=self.optionsChanged)
+        self.regex_check = qtw.QCheckBox('Regex', toolTip='Treat the term as a regular expression, '
+                                                          'matched against paths or contents',
+                                         toggled=self.optionsChanged)
+        self.fuzzy_check = qtw.QCheckBox('Fuzzy', toolTip='Match paths containing the letters of the term in order, '
+                                                          'best matches first', toggled=self.optionsChanged)
+        search_layout = qtw.QHBoxLayout()
+        search_layout.addWidget(self.search_term_inp)
+        search_layout.addWidget(self.content_check)
+        search_layout.addWidget(self.regex_check)
+        search_layout.addWidget(self.fuzzy_check)
+        self.layout().addLayout(search_layout)
+        self.layout().addWidget(self.filters_box())
+        self.results = ResultsModel()
+        # Uniform sizes spare the view from measuring every row as batches arrive
+        self.results_view = qtw.QListView(uniformItemSizes=True)
+        self.results_view.setModel(self.results)
+        self.layout().addWidget(self.results_view)
+
+    def addResults(self, results):
+        self.results.add_results(results)
+
+    def filters_box(self):
+        # Unchecked, searches use the default rules, which the filename index was built with
+        self.filters = qtw.QGroupBox('Filters', checkable=True, checked=False, toggled=self.optionsChanged)
+        self.filters.setLayout(qtw.QFormLayout())
+        self.exclude = qtw.QLineEdit(';'.join(PruneRules.default_exclude), editingFinished=self.optionsChanged,
+                                     toolTip='Names, or paths if they contain a slash, not to look in')
+        self.filters.layout().addRow('Exclude', self.exclude)
+        self.include = qtw.QLineEdit(placeholderText='e.g. *.py;*.txt', editingFinished=self.optionsChanged)
+        self.filters.layout().addRow('Include', self.include)
+        self.kind = qtw.QComboBox()
+        for label, kind in (('Files and folders', 'all'), ('Files', 'files'), ('Folders', 'dirs')):
+            self.kind.addItem(label, kind)
+        self.kind.currentIndexChanged.connect(self.optionsChanged)
+        self.filters.layout().addRow('Type', self.kind)
+        self.max_depth = qtw.QSpinBox(minimum=0, maximum=256, specialValueText='Unlimited', keyboardTracking=False,
+                                      valueChanged=self.optionsChanged)
+        self.filters.layout().addRow('Max Depth', self.max_depth)
+        self.same_filesystem = qtw.QCheckBox('Stay on the filesystem of the root', toggled=self.optionsChanged)
+        self.filters.layout().addRow('Mounts', self.same_filesystem)
+        self.min_size = qtw.QSpinBox(minimum=0, maximum=1024 * 1024, suffix=' KiB', specialValueText='Any',
+                                     keyboardTracking=False, valueChanged=self.optionsChanged)
+        self.filters.layout().addRow('Min Size', self.min_size)
+        self.max_size = qtw.QSpinBox(minimum=0, maximum=1024 * 1024, suffix=' KiB', specialValueText='Any',
+                                     keyboardTracking=False, valueChanged=self.optionsChanged)
+        self.filters.layout().addRow('Max Size', self.max_size)
+        self.modified_days = qtw.QSpinBox(minimum=0, maximum=100000, suffix=' days', specialValueText='Any time',
+                                          keyboardTracking=False, valueChanged=self.optionsChanged)
+        self.filters.layout().addRow('Modified Within', self.modified_days)
+        return self.filters
+
+    def rules(self):
+        if not self.filters.isChecked():
+            return PruneRules()
+        def patterns(line_edit):
+            return [pattern.strip() for pattern in line_edit.text().split(';') if pattern.strip()]
+        return PruneRules(
+            exclude=patterns(self.exclude),
+            max_depth=self.max_depth.value() or None,
+            same_filesystem=self.same_filesystem.isChecked(),
+            kind=self.kind.currentData(),
+            include=patterns(self.include),
+            min_size=self.min_size.value() * 1024 or None,
+            max_size=self.max_size.value() * 1024 or None,
+            modified_after=time.time() - self.modified_days.value() * 24 * 60 * 60 if self.modified_days.value() else None,
+        )
 
-    def addResult(self, result):
-        self.results.addItem(result)
+    def options(self):
+        return {'content': self.content_check.isChecked(), 'regex': self.regex_check.isChecked(),
+                'fuzzy': self.fuzzy_check.isChecked(), 'rules': self.rules()}
 
 
 
 class MainWindow(qtw.QMainWindow):
+    search_requested = qtc.pyqtSignal(str, int, dict)
+    debounce_interval = 250     # ms of no typing before a search starts
 
     def __init__(self):
         """MainWindow constructor"""
         super().__init__()
         # Main UI code goes here
-        form = SearchForm()
-        self.setCentralWidget(form)
-        self.ss = SlowSearcher()
+        self.form = SearchForm()
+        self.setCentralWidget(self.form)
+        self.index = PathIndex()
+        self.ss = SlowSearcher(self.index)
+        self.term = None
+        self.completed_term = None  # The term the results are complete for, if any
+
+        self.indexer = Indexer(self.index, qtc.QDir.rootPath())
+        self.indexer_thread = qtc.QThread()
+        self.indexer.moveToThread(self.indexer_thread)
+        self.indexer_thread.started.connect(self.indexer.start)
+        self.indexer.index_ready.connect(lambda: self.ss.use_index(self.indexer.rules))
+        self.indexer.index_ready.connect(lambda: self.statusBar().showMessage('Filename index ready'))
+        self.indexer_thread.start()
 
+        # The thread runs for the window's lifetime, searches are queued to it through search_requested
         self.searcher_thread = qtc.QThread()
         self.ss.moveToThread(self.searcher_thread)
-        self.ss.finished.connect(self.searcher_thread.quit)
         self.searcher_thread.start()
 
-        form.textChanged.connect(self.ss.set_term)
-        form.returnPressed.connect(self.ss.do_search)
-        form.returnPressed.connect(self.searcher_thread.start)
-        self.ss.match_found.connect(form.addResult)
+        self.debounce = qtc.QTimer(self, singleShot=True, interval=self.debounce_interval,
+                                   timeout=self.start_search)
+        self.form.textChanged.connect(lambda: self.debounce.start())
+        self.form.returnPressed.connect(lambda: self.start_search(force=True))
+        self.form.optionsChanged.connect(lambda: self.start_search(force=True))
+        self.search_requested.connect(self.ss.do_search)
+        self.ss.matches_found.connect(self.on_matches_found)
         self.ss.finished.connect(self.on_finished)
         self.ss.directory_changed.connect(self.on_directory_changed)
 
         # End main UI code
         self.show()
 
-    def on_finished(self):
-        qtw.QMessageBox.information(self, 'Complete', 'Search complete')
+    def start_search(self, force=False):
+        self.debounce.stop()
+        term = self.form.search_term_inp.text()
+        options = self.form.options()
+        if term == self.term and not force:
+            return
+        if options['regex']:
+            try:
+                compile_pattern(term)    # Compiled as the content search workers will compile it
+            except re.error as error:
+                self.statusBar().showMessage(f'Invalid regular expression: {error}')
+                return
+        generation = self.ss.cancel()
+        self.term = term
+        if (self.completed_term and self.completed_term in term and term != self.completed_term
+                and not (options['content'] or options['regex'] or options['fuzzy'])):
+            # Every path containing term also contains the completed one, so no need to look again
+            self.form.results.filter(lambda path: term in path)
+            self.on_finished(generation, True)
+            return
+        self.completed_term = None
+        self.form.results.clear()
+        if term:
+            self.search_requested.emit(term, generation, options)
+        else:
+            self.statusBar().clearMessage()
+
+    def closeEvent(self, event):
+        self.ss.cancel()
+        self.indexer.stop()
+        for thread in (self.searcher_thread, self.indexer_thread):
+            thread.quit()
+            thread.wait()
+        self.ss.shutdown()
+        super().closeEvent(event)
+
+    def on_matches_found(self, generation, results):
+        # Batches of a cancelled search may still be queued, they don't belong in the new results
+        if generation == self.ss.generation:
+            self.form.addResults(results)
+
+    def on_finished(self, generation, completed):
+        if generation == self.ss.generation and completed:
+            self.completed_term = self.term
+            self.statusBar().showMessage(f'Search complete: {self.form.results.rowCount()} results')
 
     def on_directory_changed(self, path):
         self.statusBar().showMessage(f'Searching in: {path}')
@@ -0,0 +1,246 @@
+"""Benchmarks and a traversal profiler for the file_seacher searcher
+
+search: generates synthetic trees (deep and narrow, shallow and wide, a mix), runs SlowSearcher over
+each for every thread count and search mode, and writes the end-to-end latency, time to the first
+result, directories/s and entries/s to a JSON report. Each run is a fresh process with cold
+interpreter state, though not a cold page cache. With --strace every run is also traced with
+strace -c, and the system calls of a search of an empty tree are subtracted to give calls per entry.
+
+profile: searches a real tree (the filesystem root by default) with per-directory timing, and prints
+the slowest directories and the time spent in each mount, to find the mounts that slow searches down.
+
+compare: prints the latency ratio of every configuration found in two search reports.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from file_seacher import SlowSearcher
+from file_seacher_index import ScanProfile
+
+TREES = {
+    # name: (depth, subdirectories per directory, files per directory) before --scale is applied to the files
+    'deep': (10, 2, 4),
+    'wide': (1, 20, 2000),
+    'mixed': (4, 6, 20),
+}
+MODES = ('name', 'fuzzy', 'content')
+WORDS = ('alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet')
+TERM = 'needle'     # In about one file name in a hundred, and the contents of about one file in a hundred
+
+
+def make_tree(root, name, scale, seed):
+    """Return the directory of tree name under root, generating it only if no earlier run completed it"""
+    depth, fanout, files = TREES[name]
+    files = max(1, round(files * scale))
+    directory = os.path.join(root, f'{name}-{files}-{seed}')
+    marker = os.path.join(directory, '.complete')
+    if os.path.exists(marker):
+        return directory
+    rng = random.Random(seed)
+    stack = [(directory, 0)]
+    while stack:
+        path, level = stack.pop()
+        os.makedirs(path, exist_ok=True)
+        for index in range(files):
+            stem = TERM if rng.random() < 0.01 else rng.choice(WORDS)
+            words = [rng.choice(WORDS) for _ in range(rng.randint(16, 512))]
+            if rng.random() < 0.01:
+                words[rng.randrange(len(words))] = TERM
+            with open(os.path.join(path, f'{stem}{index:05}.txt'), 'w', encoding='utf-8') as fh:
+                fh.write(' '.join(words))
+        if level < depth:
+            stack.extend((os.path.join(path, f'd{index:02}'), level + 1) for index in range(fanout))
+    open(marker, 'w').close()
+    return directory
+
+
+def search_once(args):
+    """Run one search in this process and print its measurements as JSON"""
+    searcher = SlowSearcher()
+    searcher.threads = args.threads
+    searcher.profile = ScanProfile()
+    results = []
+    first_result = []
+
+    def on_matches(generation, batch):
+        if not first_result:
+            first_result.append(time.perf_counter())
+        results.extend(batch)
+
+    searcher.matches_found.connect(on_matches)
+    options = {'root': args.root, 'content': args.mode == 'content', 'fuzzy': args.mode == 'fuzzy'}
+    started = time.perf_counter()
+    searcher.do_search(args.term, searcher.cancel(), options)
+    elapsed = time.perf_counter() - started
+    searcher.shutdown()
+    directories, entries, _ = searcher.profile.totals()
+    print(json.dumps({
+        'elapsed': elapsed,
+        'first_result': first_result[0] - started if first_result else None,
+        'directories': directories,
+        'entries': entries,
+        'results': len(results),
+    }))
+
+
+def parse_strace(path):
+    """Return {syscall: calls} from the summary strace -c wrote to path"""
+    calls = {}
+    with open(path, encoding='utf-8') as fh:
+        for line in fh:
+            # "% time  seconds  usecs/call  calls  [errors]  syscall", then a total line that lacks usecs/call
+            fields = line.split()
+            if len(fields) >= 5 and fields[-1] != 'total' and fields[3].isdigit():
+                calls[fields[-1]] = int(fields[3])
+    return calls
+
+
+def run_search(root, term, threads, mode, strace=False):
+    """Search root in a new process, returning its measurements, with {syscall: calls} under 'syscalls' if strace"""
+    command = [sys.executable, '-m', 'file_seacher_benchmark', 'once', root, term,
+               '--threads', str(threads), '--mode', mode]
+    with tempfile.TemporaryDirectory() as directory:
+        trace = os.path.join(directory, 'strace.txt')
+        if strace:
+            command = ['strace', '-f', '-c', '-o', trace] + command
+        process = subprocess.run(command, capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+        if process.returncode:
+            raise RuntimeError(f'{" ".join(command)} failed:\n{process.stderr}')
+        result = json.loads(process.stdout.splitlines()[-1])
+        if strace:
+            result['syscalls'] = parse_strace(trace)
+    return result
+
+
+def benchmark_search(args):
+    if args.strace and not shutil.which('strace'):
+        sys.exit('--strace needs strace on the PATH')
+    root = args.dir or os.path.join(tempfile.gettempdir(), 'file_seacher_benchmark')
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'scale': args.scale,
+            'seed': args.seed,
+            'term': args.term,
+        },
+        'trees': {},
+        'results': [],
+    }
+    baselines = {}
+    for name in args.trees:
+        source = make_tree(root, name, args.scale, args.seed)
+        for threads, mode in itertools.product(args.threads, args.modes):
+            runs = [run_search(source, args.term, threads, mode, args.strace) for _ in range(args.repeat)]
+            run = min(runs, key=lambda run: run['elapsed'])
+            report['trees'][name] = {'directories': run['directories'], 'entries': run['entries']}
+            result = {
+                'tree': name,
+                'threads': threads,
+                'mode': mode,
+                'elapsed': run['elapsed'],
+                'first_result': run['first_result'],
+                'directories_per_s': run['directories'] / run['elapsed'],
+                'entries_per_s': run['entries'] / run['elapsed'],
+                'results': run['results'],
+            }
+            if args.strace:
+                if (threads, mode) not in baselines:
+                    with tempfile.TemporaryDirectory() as empty:
+                        baselines[threads, mode] = run_search(empty, args.term, threads, mode, True)['syscalls']
+                baseline = baselines[threads, mode]
+                syscalls = {call: count - baseline.get(call, 0) for call, count in run['syscalls'].items()}
+                result['syscalls'] = syscalls
+                result['syscalls_per_entry'] = sum(syscalls.values()) / max(1, run['entries'])
+            report['results'].append(result)
+            first = f"{result['first_result'] * 1000:>8.1f}" if result['first_result'] is not None else f'{"-":>8}'
+            print(f"{name:>6} {threads:>3} threads {mode:>7}: {result['elapsed'] * 1000:>9.1f} ms, first {first} ms "
+                  f"{result['directories_per_s']:>9.0f} dirs/s {result['entries_per_s']:>10.0f} entries/s"
+                  + (f" {result['syscalls_per_entry']:>6.2f} syscalls/entry" if args.strace else ''))
+    with open(args.output, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2)
+    print(f'Report written to {args.output}')
+
+
+def profile_traversal(args):
+    searcher = SlowSearcher()
+    searcher.threads = args.threads
+    searcher.profile = ScanProfile()
+    started = time.perf_counter()
+    # A term no path contains, so the whole tree is listed
+    searcher.do_search('\0', searcher.cancel(), {'root': args.root})
+    elapsed = time.perf_counter() - started
+    directories, entries, listing = searcher.profile.totals()
+    print(f'{directories} directories, {entries} entries in {elapsed:.1f} s '
+          f'({listing:.1f} s spent listing across {args.threads} threads)')
+    print(f'\n{"seconds":>9} {"dirs":>8} {"entries":>9}  mount')
+    for mount, mount_directories, mount_entries, seconds in searcher.profile.by_mount():
+        print(f'{seconds:>9.3f} {mount_directories:>8} {mount_entries:>9}  {mount}')
+    print(f'\n{"seconds":>9} {"entries":>9}  slowest directories')
+    for path, seconds, path_entries in searcher.profile.slowest(args.count):
+        print(f'{seconds:>9.3f} {path_entries:>9}  {path}')
+
+
+def compare_reports(args):
+    def load(path):
+        with open(path, encoding='utf-8') as fh:
+            results = json.load(fh)['results']
+        return {(r['tree'], r['threads'], r['mode']): r for r in results}
+
+    before, after = load(args.before), load(args.after)
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        print(f'{key[0]:>6} {key[1]:>3} threads {key[2]:>7}: '
+              f"latency x{new['elapsed'] / old['elapsed']:.2f} "
+              f"dirs/s x{new['directories_per_s'] / old['directories_per_s']:.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    search = subparsers.add_parser('search', help='time the searcher over synthetic trees')
+    search.add_argument('--trees', nargs='+', choices=TREES, default=list(TREES))
+    search.add_argument('--scale', type=float, default=1.0, help='multiplies the number of files in each directory')
+    search.add_argument('--seed', type=int, default=0)
+    search.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16])
+    search.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    search.add_argument('--term', default=TERM)
+    search.add_argument('--repeat', type=int, default=1, help='runs per configuration, the fastest is kept')
+    search.add_argument('--strace', action='store_true', help='count system calls per entry with strace')
+    search.add_argument('--dir', help='where the trees are generated and kept between runs')
+    search.add_argument('--output', default='search_benchmark.json')
+    search.set_defaults(run=benchmark_search)
+    profile = subparsers.add_parser('profile', help='find the slowest directories and mounts of a real tree')
+    profile.add_argument('root', nargs='?', default=os.sep)
+    profile.add_argument('--threads', type=int, default=16)
+    profile.add_argument('--count', type=int, default=20, help='how many of the slowest directories to show')
+    profile.set_defaults(run=profile_traversal)
+    compare = subparsers.add_parser('compare', help='compare two search reports')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    compare.set_defaults(run=compare_reports)
+    # Runs a single search for the search benchmark, in a process of its own
+    once = subparsers.add_parser('once')
+    once.add_argument('root')
+    once.add_argument('term')
+    once.add_argument('--threads', type=int, default=16)
+    once.add_argument('--mode', choices=MODES, default='name')
+    once.set_defaults(run=search_once)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
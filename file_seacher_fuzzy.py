@@ -0,0 +1,108 @@
+"""Fuzzy filename matching for file_seacher: the term's characters in order, anywhere in the path, ranked like fzf"""
+import heapq
+import os
+import re
+
+SCORE_MATCH = 16
+BONUS_CONSECUTIVE = 8
+BONUS_SEPARATOR = 10    # A match right after a path separator, the start of a name
+BONUS_BOUNDARY = 8      # After _ - . or a space, or a lower-case letter followed by an upper-case one
+BONUS_BASENAME = 24     # The whole term matched within the file name
+PENALTY_GAP_START = 3
+PENALTY_GAP_EXTENSION = 1
+
+
+def ignores_case(term):
+    """Smart case: a term in lower case matches either case, one with capitals only itself"""
+    return term == term.lower()
+
+
+def subsequence_pattern(term):
+    """A regex matching text that contains the characters of term in order
+
+    Each gap is [^c]* for the next character c, so the first occurrence is taken and nothing backtracks.
+    """
+    parts = [re.escape(term[0])]
+    parts.extend(f'[^{re.escape(char)}]*{re.escape(char)}' for char in term[1:])
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL if ignores_case(term) else re.DOTALL)
+
+
+def fold_case(text):
+    """text in lower case, one character for each of text's so positions in it are positions in text"""
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    # A few characters lower to more than one, e.g. 'İ' to 'i' and a combining dot; keep the first
+    return ''.join(char.lower()[0] for char in text)
+
+
+def match_positions(text, term):
+    """Return the positions in text of a tight match of term, preferring one as far right as possible, or None
+
+    A backward pass from the end finds where the rightmost match starts, then a forward pass from
+    there finds the earliest end, so the match sits in the file name where it can and has few gaps.
+    """
+    position = len(text)
+    for char in reversed(term):
+        position = text.rfind(char, 0, position)
+        if position < 0:
+            return None
+    positions = []
+    for char in term:
+        position = text.find(char, position)
+        positions.append(position)
+        position += 1
+    return positions
+
+
+def fuzzy_score(path, term):
+    """Return how well path matches term, higher is better, or None if it doesn't match at all"""
+    text = fold_case(path) if ignores_case(term) else path
+    positions = match_positions(text, term)
+    if positions is None:
+        return None
+    score = 0
+    previous = None
+    for position in positions:
+        score += SCORE_MATCH
+        before = path[position - 1] if position else os.sep
+        if before == os.sep:
+            score += BONUS_SEPARATOR
+        elif before in '_-. ' or before.islower() and path[position].isupper():
+            score += BONUS_BOUNDARY
+        if previous is not None:
+            gap = position - previous - 1
+            if gap:
+                score -= PENALTY_GAP_START + PENALTY_GAP_EXTENSION * (gap - 1)
+            else:
+                score += BONUS_CONSECUTIVE
+        previous = position
+    if positions[0] > path.rfind(os.sep):
+        score += BONUS_BASENAME
+    return score
+
+
+class FuzzyRanking:
+    """The best limit matches of term among the paths added, kept in a heap as batches come in"""
+
+    def __init__(self, term, limit=1000):
+        self.term = term
+        self.pattern = subsequence_pattern(term)
+        self.limit = limit
+        self.heap = []      # (score, -len(path), path), the worst kept match first
+
+    def add(self, paths):
+        # The regex weeds out non-matches in C, only the survivors are scored in Python
+        for path in filter(self.pattern.search, paths):
+            score = fuzzy_score(path, self.term)
+            if score is None:
+                continue    # The regex folds case a little more widely, e.g. 'ſ' matches 's'
+            entry = (score, -len(path), path)
+            if len(self.heap) < self.limit:
+                heapq.heappush(self.heap, entry)
+            elif entry > self.heap[0]:
+                heapq.heapreplace(self.heap, entry)
+
+    def best(self):
+        """Return the matching paths, best first; shorter paths win ties"""
+        return [path for *_, path in sorted(self.heap, reverse=True)]
@@ -0,0 +1,90 @@
+"""Content search for file_seacher, kept free of Qt so the process pool's workers start quickly"""
+import mmap
+import os
+import re
+from functools import lru_cache
+
+SNIFF_SIZE = 8192       # Files with a NUL byte in this much of their start are taken as binary
+MAX_LINE_LENGTH = 200   # Longer matching lines are cut to this many characters around the match
+BLOCK_SIZE = 1024 * 1024    # Regexes run over the text of about this much of a file at a time
+
+
+@lru_cache(maxsize=16)
+def compile_pattern(term):
+    # The same str pattern the form checked, so non-ASCII terms and . match characters rather than bytes
+    return re.compile(term, re.MULTILINE)
+
+
+def grep_lines(data, find, line_number, hits):
+    """Add (line number, line) to hits for each line of data, bytes or str, with a match in it
+
+    find(position) returns the offset of the next match at or after position, or -1. line_number is
+    the number of data's first line.
+    """
+    newline = '\n' if isinstance(data, str) else b'\n'
+    size = len(data)
+    position = line_start = 0
+    while True:
+        found = find(position)
+        if found < 0 or found == size and data[size - 1:size] == newline:
+            break   # An empty match after the final newline isn't on a line of its own
+        start = data.rfind(newline, 0, found) + 1
+        line_end = data.find(newline, found)
+        line_end = size if line_end < 0 else line_end
+        line_number += data[line_start:start].count(newline)
+        line_start = start
+        end = line_end
+        if end - start > MAX_LINE_LENGTH:
+            start = max(start, found - MAX_LINE_LENGTH // 2)
+            end = min(start + MAX_LINE_LENGTH, line_end)   # Not into the lines that follow
+        line = data[start:end]
+        hits.append((line_number, (line if isinstance(line, str) else line.decode(errors='replace')).strip()))
+        if line_end >= size:
+            break   # Searching again from size would find an empty match there forever
+        position = line_end + 1     # One hit per line
+
+
+def grep_file(path, term, regex=False):
+    """Return (line number, line) for each line of path matching term, or nothing if path looks binary"""
+    hits = []
+    try:
+        with open(path, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            # Nothing to map, and files like those in /proc that report no size may block when read
+            if not size or b'\0' in fh.read(SNIFF_SIZE):
+                return hits
+            with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if not regex:
+                    # A UTF-8 term is found in the raw bytes wherever it is in the text
+                    needle = term.encode()
+                    grep_lines(data, lambda position: data.find(needle, position), 1, hits)
+                    return hits
+                pattern = compile_pattern(term)
+                line_number = 1
+                block_start = 0
+                while block_start < size:
+                    # Blocks end after a newline, so no line or multibyte character is split between two
+                    block_end = data.rfind(b'\n', block_start, block_start + BLOCK_SIZE) + 1
+                    if block_start + BLOCK_SIZE >= size:
+                        block_end = size
+                    elif not block_end:
+                        block_end = data.find(b'\n', block_start + BLOCK_SIZE) + 1 or size
+                    text = data[block_start:block_end].decode(errors='replace')
+
+                    def find(position):
+                        match = pattern.search(text, position)
+                        return match.start() if match else -1
+
+                    grep_lines(text, find, line_number, hits)
+                    line_number += text.count('\n')
+                    block_start = block_end
+    except (OSError, ValueError):
+        pass
+    return hits
+
+
+def grep_files(paths, term, regex=False):
+    """Return 'path:line: text' for every hit in paths, the unit of work handed to a pool worker"""
+    return [f'{path}:{line_number}: {line}'
+            for path in paths
+            for line_number, line in grep_file(path, term, regex)]
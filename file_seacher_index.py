@@ -0,0 +1,422 @@
+import os
+import sqlite3
+import threading
+import time
+from fnmatch import fnmatch
+from PyQt5 import QtCore as qtc
+from file_seacher_watch import TreeWatcher, WatchLimitReached
+from sqlite_paths import glob_escape, storable
+
+
+class PathIndex:
+    """Every path under a root in SQLite, with an FTS5 trigram index so substring searches don't scan them all
+
+    Connections can't be shared between threads, so each thread that uses the index calls connect().
+    Builds go into a fresh table that replaces the live one when complete, searches keep working meanwhile.
+    Paths that aren't valid UTF-8 can't be stored as SQLite text, so they are left out of the index.
+    """
+
+    default_path = os.path.join(os.path.expanduser('~'), '.cache', 'file_seacher_index.sqlite3')
+    batch_size = 10000
+
+    def __init__(self, path=default_path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self.create_table(db, 'paths')
+        return db
+
+    @staticmethod
+    def create_table(db, name):
+        try:
+            # case_sensitive keeps GLOB queries on the index, matching the searcher's plain `term in path`
+            db.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {name} '
+                       "USING fts5(path, tokenize='trigram case_sensitive 1')")
+        except sqlite3.OperationalError:     # SQLite older than 3.34, or built without FTS5
+            db.execute(f'CREATE TABLE IF NOT EXISTS {name} (path TEXT)')
+
+    @staticmethod
+    def get_meta(db, key, default=None):
+        row = db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def built_at(self, db, root, rules=None):
+        """Return when the index of root under rules was last completed, or None if it never was"""
+        if self.get_meta(db, 'root') != root or self.get_meta(db, 'rules') != repr(rules):
+            return None
+        return self.get_meta(db, 'built_at')
+
+    def build(self, db, root, paths, should_stop=lambda: False, rules=None):
+        """Replace the index with paths, an iterable of everything rules keep under root; returns False if stopped"""
+        db.execute('DROP TABLE IF EXISTS paths_new')
+        self.create_table(db, 'paths_new')
+        batch = []
+        for path in filter(storable, paths):
+            batch.append((path,))
+            if len(batch) >= self.batch_size:
+                if should_stop():
+                    db.execute('DROP TABLE paths_new')
+                    db.commit()
+                    return False
+                db.executemany('INSERT INTO paths_new VALUES (?)', batch)
+                db.commit()
+                batch.clear()
+        db.executemany('INSERT INTO paths_new VALUES (?)', batch)
+        with db:
+            db.execute('DROP TABLE paths')
+            db.execute('ALTER TABLE paths_new RENAME TO paths')
+            db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                           (('root', root), ('rules', repr(rules)), ('built_at', time.time())))
+        return True
+
+    def add(self, db, path, paths):
+        """Replace path and everything indexed below it with paths"""
+        self.remove(db, path)
+        db.executemany('INSERT INTO paths VALUES (?)', ((path,) for path in filter(storable, paths)))
+
+    def remove(self, db, path):
+        """Remove path and, if it is a directory, everything below it"""
+        if not storable(path):
+            return      # Neither it nor anything below it was indexed
+        pattern = glob_escape(path)
+        # Separate statements, as FTS5 can only use the trigram index for a single GLOB, not an OR of two
+        db.execute('DELETE FROM paths WHERE path GLOB ?', (pattern,))
+        db.execute('DELETE FROM paths WHERE path GLOB ?', (pattern + glob_escape(os.sep) + '*',))
+
+    def search(self, db, term):
+        """Yield the indexed paths that contain term"""
+        for path, in db.execute('SELECT path FROM paths WHERE path GLOB ?', (f'*{glob_escape(term)}*',)):
+            yield path
+
+    def search_subsequence(self, db, term, ignore_case):
+        """Yield the indexed paths that contain the characters of term in order"""
+        if ignore_case:
+            # LIKE only folds ASCII letters, so other capitals in a path don't match their lower case here
+            chars = ['\\' + char if char in '%_\\' else char for char in term]
+            query, pattern = "SELECT path FROM paths WHERE path LIKE ? ESCAPE '\\'", f"%{'%'.join(chars)}%"
+        else:
+            query, pattern = 'SELECT path FROM paths WHERE path GLOB ?', f"*{'*'.join(map(glob_escape, term))}*"
+        for path, in db.execute(query, (pattern,)):
+            yield path
+
+
+class PruneRules:
+    """What a traversal leaves out
+
+    exclude, max_depth and same_filesystem prune before a directory is listed, so nothing below it is touched.
+    Exclude patterns match an entry's name, or its full path if they contain a slash. max_depth counts
+    directory levels below the root, entries in the root are at depth 1.
+    kind ('all', 'files' or 'dirs'), include (name patterns), min_size/max_size (bytes, files only) and
+    modified_after/modified_before (timestamps) only drop entries from the results, and cost a stat per
+    entry when the size or time filters are set.
+    """
+
+    default_exclude = ('/proc', '/sys', '/dev', '/run', 'node_modules', '__pycache__')
+
+    def __init__(self, exclude=default_exclude, max_depth=None, same_filesystem=False, kind='all', include=(),
+                 min_size=None, max_size=None, modified_after=None, modified_before=None):
+        self.exclude = tuple(exclude)
+        self.max_depth = max_depth
+        self.same_filesystem = same_filesystem
+        self.kind = kind
+        self.include = tuple(include)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+
+    def __repr__(self):
+        return f'PruneRules({", ".join(f"{name}={value!r}" for name, value in vars(self).items())})'
+
+    def __eq__(self, other):
+        return isinstance(other, PruneRules) and vars(self) == vars(other)
+
+    def needs_stat(self):
+        return any(value is not None for value in (self.min_size, self.max_size,
+                                                   self.modified_after, self.modified_before))
+
+    def excluded(self, name, path):
+        return any(fnmatch(path if '/' in pattern else name, pattern) for pattern in self.exclude)
+
+    def descend(self, depth):
+        """Whether to list the subdirectories of a directory at depth"""
+        return self.max_depth is None or depth < self.max_depth
+
+    def keep(self, entry, is_dir):
+        """Whether the scandir entry belongs in the results"""
+        if self.kind == 'files' and is_dir or self.kind == 'dirs' and not is_dir:
+            return False
+        if self.include and not any(fnmatch(entry.name, pattern) for pattern in self.include):
+            return False
+        if self.needs_stat():
+            stat = entry.stat(follow_symlinks=False)
+            if not is_dir and (self.min_size is not None and stat.st_size < self.min_size
+                               or self.max_size is not None and stat.st_size > self.max_size):
+                return False
+            if (self.modified_after is not None and stat.st_mtime < self.modified_after
+                    or self.modified_before is not None and stat.st_mtime > self.modified_before):
+                return False
+        return True
+
+    def narrows(self, other):
+        """Whether paths kept by other can be cut down to those kept by these rules from the paths alone"""
+        return (other.kind == 'all' and not other.include and not other.needs_stat()
+                and self.kind == 'all' and not self.needs_stat()
+                and set(other.exclude) <= set(self.exclude)
+                and (other.max_depth is None or self.max_depth is not None and self.max_depth <= other.max_depth)
+                and self.same_filesystem == other.same_filesystem)
+
+    def keep_path(self, path, root):
+        """Whether a path found under root with other rules that these narrow, is kept by these"""
+        parts = os.path.relpath(path, root).split(os.sep)
+        if self.max_depth is not None and len(parts) > self.max_depth:
+            return False
+        if any(part.startswith('.') for part in parts):
+            return False
+        for depth in range(1, len(parts) + 1):
+            if self.excluded(parts[depth - 1], os.path.join(root, *parts[:depth])):
+                return False
+        return not self.include or any(fnmatch(parts[-1], pattern) for pattern in self.include)
+
+
+def scan_directory(path, rules=None, device=None):
+    """Return the paths, subdirectories and regular files in path, skipping hidden entries and symlinks like QDir
+
+    scandir gets the type of each entry from the directory listing itself, so nothing here needs a stat
+    on filesystems that report it. With rules, paths and files are only those the rules keep, and
+    subdirectories only those not excluded; with device, only those on that device.
+    """
+    paths, subdirs, files = [], [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or entry.is_symlink():
+                    continue
+                if rules and rules.excluded(entry.name, entry.path):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    # A mount point's own stat is already that of the filesystem mounted on it
+                    if is_dir and (device is None or entry.stat(follow_symlinks=False).st_dev == device):
+                        subdirs.append(entry.path)
+                    if rules and not rules.keep(entry, is_dir):
+                        continue
+                    paths.append(entry.path)
+                    if not is_dir and entry.is_file(follow_symlinks=False):
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return paths, subdirs, files
+
+
+def root_device(root, rules):
+    """The device a traversal of root under rules stays on, or None if it may cross filesystems"""
+    if not rules or not rules.same_filesystem:
+        return None
+    try:
+        return os.stat(root).st_dev
+    except OSError:
+        return None
+
+
+def mount_points():
+    """Return the mount points from /proc/self/mountinfo, longest first so the first prefix of a path is its mount"""
+    try:
+        with open('/proc/self/mountinfo', encoding='utf-8') as fh:
+            # The fields are "id parent dev root mountpoint ...", with spaces in paths escaped as \\040
+            mounts = {line.split()[4].replace('\\040', ' ') for line in fh}
+    except OSError:
+        return [os.sep]
+    return sorted(mounts, key=len, reverse=True)
+
+
+class ScanProfile:
+    """Times every directory a traversal lists, to find the directories and mounts that make searches slow
+
+    scan() stands in for scan_directory() and may be called from several threads at once.
+    """
+
+    def __init__(self):
+        self.listings = {}      # path: (seconds, entries kept by the rules)
+        self.lock = threading.Lock()
+
+    def scan(self, path, rules=None, device=None):
+        started = time.perf_counter()
+        result = scan_directory(path, rules, device)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.listings[path] = (elapsed, len(result[0]))
+        return result
+
+    def totals(self):
+        """Return (directories, entries, seconds listing them) over everything listed so far"""
+        with self.lock:
+            listings = list(self.listings.values())
+        return len(listings), sum(entries for _, entries in listings), sum(seconds for seconds, _ in listings)
+
+    def slowest(self, count=20):
+        """Return the count slowest (path, seconds, entries)"""
+        with self.lock:
+            listings = list(self.listings.items())
+        return [(path, seconds, entries) for path, (seconds, entries)
+                in sorted(listings, key=lambda item: item[1][0], reverse=True)[:count]]
+
+    def by_mount(self):
+        """Return (mount point, directories, entries, seconds) for each mount listed in, slowest first"""
+        mounts = mount_points()
+        totals = {}
+        with self.lock:
+            listings = list(self.listings.items())
+        for path, (seconds, entries) in listings:
+            mount = next((mount for mount in mounts
+                          if path == mount or path.startswith(mount.rstrip(os.sep) + os.sep)), os.sep)
+            directories, total_entries, total_seconds = totals.get(mount, (0, 0, 0.0))
+            totals[mount] = (directories + 1, total_entries + entries, total_seconds + seconds)
+        return sorted(((mount, *total) for mount, total in totals.items()), key=lambda row: row[3], reverse=True)
+
+
+def iter_tree(root, rules=None, listing=None, depth=0):
+    """Yield every path below root that rules keep, calling listing(directory) before each directory is listed
+
+    depth is root's own depth, for a subtree of the tree the rules' max depth is counted from.
+    """
+    device = root_device(root, rules)
+    stack = [(root, depth)]
+    while stack:
+        path, depth = stack.pop()
+        if listing:
+            listing(path)
+        paths, subdirs, _ = scan_directory(path, rules, device)
+        yield from paths
+        if not rules or rules.descend(depth + 1):
+            stack.extend((subdir, depth + 1) for subdir in subdirs)
+
+
+class Indexer(qtc.QObject):
+    """Builds the PathIndex in the background and keeps it fresh
+
+    Where inotify is available every directory is watched as the build lists it, and changes are applied
+    to the index every events_interval; it is only rebuilt if events were lost. Elsewhere, or once the
+    watch limit is reached, it is rebuilt when older than refresh_interval.
+    Changes only get the path rules (exclude, depth, include) applied, the stat based ones need a rebuild.
+    """
+
+    index_ready = qtc.pyqtSignal()
+    refresh_interval = 60 * 60
+    events_interval = 1000     # ms
+
+    def __init__(self, index, root, rules=None):
+        super().__init__()
+        self.index = index
+        self.root = root
+        self.rules = rules or PruneRules()
+        self.stopping = False
+        self.timer = None
+        self.events_timer = None
+        self.watcher = None
+        self.watching = False   # True once a build has set up watches on the whole tree
+        self.rescan = False
+
+    @qtc.pyqtSlot()
+    def start(self):
+        """Build now if the index is missing or stale, then keep it fresh; call once in the indexer's thread"""
+        try:
+            self.watcher = TreeWatcher()
+        except OSError as error:
+            print(f'Live index updates unavailable, rescanning every {self.refresh_interval} s: {error}')
+        self.timer = qtc.QTimer(self, interval=60 * 1000, timeout=self.refresh)
+        self.events_timer = qtc.QTimer(self, interval=self.events_interval, timeout=self.apply_events)
+        # Timers must be stopped by their own thread, so do it as that thread finishes
+        self.thread().finished.connect(self.timer.stop)
+        self.thread().finished.connect(self.events_timer.stop)
+        self.timer.start()
+        self.events_timer.start()
+        self.refresh()
+
+    @qtc.pyqtSlot()
+    def refresh(self):
+        try:
+            self.update_index()
+        except Exception as error:
+            # PyQt aborts the application on an exception escaping a slot, searches can still walk the tree
+            print(f'Index update failed: {error!r}')
+
+    def update_index(self):
+        db = self.index.connect()
+        try:
+            built_at = self.index.built_at(db, self.root, self.rules)
+            if built_at is not None:
+                self.index_ready.emit()
+            if self.needs_build(built_at):
+                self.rescan = False
+                listing = self.watch if self.watcher else None
+                paths = iter_tree(self.root, self.rules, listing)
+                if self.index.build(db, self.root, paths, lambda: self.stopping, self.rules):
+                    self.watching = self.watcher is not None
+                    self.index_ready.emit()
+        finally:
+            db.close()
+
+    def needs_build(self, built_at):
+        if built_at is None or self.rescan:
+            return True
+        if self.watcher:
+            # Changes made while nothing watched, e.g. before this run, are only picked up by a build
+            return not self.watching
+        return time.time() - built_at > self.refresh_interval
+
+    def watch(self, path):
+        if not self.watcher:
+            return
+        try:
+            self.watcher.watch(path)
+        except WatchLimitReached as error:
+            print(f'Live index updates stopped, rescanning every {self.refresh_interval} s: {error}')
+            self.watcher.close()
+            self.watcher = None
+            self.watching = False
+
+    @qtc.pyqtSlot()
+    def apply_events(self):
+        if not self.watching or self.stopping:
+            return
+        try:
+            self.apply_changes()
+        except Exception as error:
+            print(f'Applying filesystem changes to the index failed: {error!r}')
+            self.rescan = True      # Whatever was missed is picked up by the next refresh
+
+    def apply_changes(self):
+        changes, overflowed = self.watcher.take()
+        if overflowed:
+            self.rescan = True
+            self.refresh()
+            return
+        if not changes:
+            return
+        db = self.index.connect()
+        try:
+            with db:
+                for path, is_dir, added in changes:
+                    if not added:
+                        self.index.remove(db, path)
+                    elif self.rules.keep_path(path, self.root):
+                        # A directory may arrive with contents, when moved here
+                        depth = len(os.path.relpath(path, self.root).split(os.sep))
+                        listed = is_dir and self.rules.descend(depth)
+                        below = iter_tree(path, self.rules, self.watch, depth) if listed else ()
+                        self.index.add(db, path, [path, *below])
+        finally:
+            db.close()
+
+    def stop(self):
+        """Abandon a build in progress and stop watching, safe to call from any thread"""
+        self.stopping = True
+        if self.watcher:
+            self.watcher.close()
@@ -0,0 +1,151 @@
+"""Live changes to the tree under file_seacher's index, from Linux inotify through ctypes so nothing needs installing"""
+import collections
+import ctypes
+import errno
+import os
+import selectors
+import struct
+import threading
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+EVENT = struct.Struct('iIII')   # wd, mask, cookie, length of the name that follows
+
+
+class WatchLimitReached(OSError):
+    """The user's inotify watches (fs.inotify.max_user_watches) are used up"""
+
+
+class TreeWatcher:
+    """Watches directories with inotify and queues their changes from a reader thread
+
+    At most max_events are held; past that, or if the kernel's own queue overflows, the events are
+    dropped and take() reports the overflow so the caller can rescan instead.
+    Raises OSError where inotify isn't available.
+    """
+
+    max_events = 100000
+
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available') from None
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # Only used by the thread calling watch() and take()
+        self.paths = {}     # wd: directory
+        self.wds = {}       # directory: wd
+        self.children = {}  # directory: its watched subdirectories, so unwatch() only visits the subtree
+        self.events = collections.deque()
+        self.overflowed = False
+        self.lock = threading.Lock()
+        self.wakeup, self.stop_writer = os.pipe()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def watch(self, path):
+        """Start watching the directory path, quietly skipping those that are gone or unreadable"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise WatchLimitReached(error, 'inotify watch limit reached', path)
+            return
+        if self.paths.get(wd, path) != path:
+            self.forget(wd)     # The same directory reached by another path
+        self.paths[wd] = path
+        self.wds[path] = wd
+        self.children.setdefault(os.path.dirname(path), set()).add(path)
+
+    def forget(self, wd):
+        path = self.paths.pop(wd, None)
+        if path is None or self.wds.get(path) != wd:
+            return
+        del self.wds[path]
+        parent = os.path.dirname(path)
+        siblings = self.children.get(parent)
+        if siblings:
+            siblings.discard(path)
+            if not siblings:
+                del self.children[parent]
+
+    def unwatch(self, path):
+        """Stop watching path and every directory below it"""
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            stack.extend(self.children.pop(directory, ()))
+            wd = self.wds.get(directory)
+            if wd is not None:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.forget(wd)
+
+    def take(self):
+        """Return (changes, overflowed) since the last call; changes are (path, is_dir, added) in order"""
+        with self.lock:
+            events, self.events = self.events, collections.deque()
+            overflowed, self.overflowed = self.overflowed, False
+        changes = []
+        for wd, mask, name in events:
+            if mask & IN_IGNORED:
+                self.forget(wd)
+                continue
+            directory = self.paths.get(wd)
+            if directory is None:
+                continue    # Unwatched since the event was queued
+            path = os.path.join(directory, os.fsdecode(name))
+            is_dir = bool(mask & IN_ISDIR)
+            if mask & (IN_DELETE | IN_MOVED_FROM):
+                if is_dir and mask & IN_MOVED_FROM:
+                    # Watches follow a moved directory, they're set up again under its new path if it shows up.
+                    # A deleted one's watch is dropped by the kernel, which sends IN_IGNORED for it
+                    self.unwatch(path)
+                changes.append((path, is_dir, False))
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changes.append((path, is_dir, True))
+        return changes, overflowed
+
+    def close(self):
+        """Stop the reader thread, which closes the inotify descriptor; safe to call from any thread"""
+        os.write(self.stop_writer, b'\0')
+
+    def _read(self):
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.fd, selectors.EVENT_READ)
+            selector.register(self.wakeup, selectors.EVENT_READ)
+            while all(key.fd == self.fd for key, _ in selector.select()):
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                events, overflowed, offset = [], False, 0
+                while offset < len(data):
+                    wd, mask, _, length = EVENT.unpack_from(data, offset)
+                    offset += EVENT.size
+                    name = data[offset:offset + length].rstrip(b'\0')
+                    offset += length
+                    if mask & IN_Q_OVERFLOW:
+                        overflowed = True
+                    elif name or mask & IN_IGNORED:
+                        events.append((wd, mask, name))
+                with self.lock:
+                    self.events.extend(events)
+                    if overflowed or len(self.events) > self.max_events:
+                        self.events.clear()
+                        self.overflowed = True
+        for fd in (self.fd, self.wakeup, self.stop_writer):
+            os.close(fd)
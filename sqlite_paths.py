@@ -0,0 +1,18 @@
+"""Helpers for keeping filesystem paths in SQLite, shared by file_hasher's cache and file_seacher's index"""
+
+
+def glob_escape(text):
+    """Return text with GLOB's wildcards escaped, by putting each in a character class of its own"""
+    return ''.join(f'[{char}]' if char in '*?[' else char for char in text)
+
+
+def storable(path):
+    """Whether path can be stored as SQLite text
+
+    os.fsdecode turns bytes that aren't valid UTF-8 into lone surrogates, which sqlite3 refuses to encode.
+    """
+    try:
+        path.encode()
+    except UnicodeEncodeError:
+        return False
+    return True
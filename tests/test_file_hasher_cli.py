@@ -0,0 +1,284 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_cli(*args, timeout=60):
+    return subprocess.run([sys.executable, '-m', 'file_hasher_cli', *args, '--progress', 'none'],
+                          cwd=REPO, capture_output=True, text=True, timeout=timeout)
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_bytes_are_reported_before_a_file_finishes(self):
+        # bytes_done used to stay at 0 until the whole file had been hashed
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            with open(os.path.join(source, 'big'), 'wb') as fh:
+                fh.write(os.urandom(1024 * 1024) * 96)
+            for backend in ('threads', 'processes'):
+                with self.subTest(backend=backend):
+                    process = subprocess.run(
+                        [sys.executable, '-m', 'file_hasher_cli', source, os.path.join(directory, 'out.txt'),
+                         '-a', 'sha256', '-a', 'sha1', '-a', 'md5', '--chunk-size', '64', '--read-strategy', 'read',
+                         '--backend', backend, '--progress-interval', '0.01'],
+                        cwd=REPO, capture_output=True, text=True, timeout=60)
+                    self.assertEqual(process.returncode, 0, process.stderr)
+                    progress = [json.loads(line) for line in process.stderr.splitlines()]
+                    self.assertTrue(any(0 < line['bytes_done'] < line['bytes_found'] and not line['files_done']
+                                        for line in progress), progress)
+                    self.assertEqual(progress[-1]['bytes_done'], 96 * 1024 * 1024)
+
+
+class ReadStrategyTest(unittest.TestCase):
+
+    def test_auto_doesnt_map_files_on_the_thread_backend(self):
+        # A mapped file truncated while being hashed raises SIGBUS, which kills the process running the threads
+        script = (
+            'import sys, file_hasher_engine, file_hasher_cli\n'
+            'choose_strategy = file_hasher_engine.choose_strategy\n'
+            'def refuse_mmap(*args, **kwargs):\n'
+            '    if choose_strategy(*args, **kwargs) == "mmap":\n'
+            '        raise AssertionError("mapped")\n'
+            '    return "read"\n'
+            'file_hasher_engine.choose_strategy = refuse_mmap\n'
+            'sys.exit(file_hasher_cli.main(sys.argv[1:]))\n'
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            with open(os.path.join(source, 'big'), 'wb') as fh:
+                fh.write(b'\0' * 8 * 1024 * 1024)
+            process = subprocess.run([sys.executable, '-c', script, source, os.path.join(directory, 'out.txt'),
+                                      '--progress', 'none'], cwd=REPO, capture_output=True, text=True, timeout=60)
+            self.assertEqual(process.returncode, 0, process.stderr)
+
+
+class DedupeTest(unittest.TestCase):
+
+    def test_hard_links_above_probe_size_are_final(self):
+        # Used to go to the full-hash round, where on_hashed raised KeyError and the job never finished
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            with open(os.path.join(source, 'a'), 'wb') as fh:
+                fh.write(os.urandom(300001))
+            os.link(os.path.join(source, 'a'), os.path.join(source, 'b'))
+            report = os.path.join(directory, 'report.txt')
+            process = run_cli(source, report, '--mode', 'dedupe')
+            self.assertEqual(process.returncode, 0, process.stderr)
+            with open(report, encoding='utf-8') as fh:
+                lines = fh.read().splitlines()
+            self.assertEqual(lines[0], '# 2 files of 300001 bytes, hard links')
+            self.assertEqual(sorted(lines[1:3]), [os.path.join(source, 'a'), os.path.join(source, 'b')])
+
+    def test_hard_links_are_reported_beside_other_files_of_their_size(self):
+        # Were only reported when no other inode had the same size
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            for name in ('a', 'b'):
+                with open(os.path.join(source, name), 'wb') as fh:
+                    fh.write(name.encode())
+            os.link(os.path.join(source, 'a'), os.path.join(source, 'a2'))
+            report = os.path.join(directory, 'report.txt')
+            process = run_cli(source, report, '--mode', 'dedupe')
+            self.assertEqual(process.returncode, 0, process.stderr)
+            with open(report, encoding='utf-8') as fh:
+                lines = fh.read().splitlines()
+            self.assertEqual(lines[0], '# 2 files of 1 bytes, hard links')
+            self.assertEqual(sorted(lines[1:3]), [os.path.join(source, 'a'), os.path.join(source, 'a2')])
+            self.assertEqual(len(lines), 4)
+
+
+class VerifyTest(unittest.TestCase):
+
+    def test_cache_mismatch_is_reported_and_fails(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            path = os.path.join(source, 'a')
+            with open(path, 'wb') as fh:
+                fh.write(b'before')
+            cache = os.path.join(directory, 'cache.sqlite3')
+            self.assertEqual(run_cli(source, os.path.join(directory, 'first.txt'), '--cache', cache).returncode, 0)
+            # Same size and mtime, so only re-reading the file can tell it changed
+            stat = os.stat(path)
+            with open(path, 'r+b') as fh:
+                fh.write(b'after!')
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            report = os.path.join(directory, 'second.txt')
+            process = run_cli(source, report, '--cache', cache, '--verify')
+            self.assertEqual(process.returncode, 1, process.stderr)
+            with open(report, encoding='utf-8') as fh:
+                self.assertIn(f'# MISMATCHED\t{path}\t', fh.read())
+
+    def test_manifest_paths_are_normalised(self):
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'sub'))
+            with open(os.path.join(directory, 'sub', 'f'), 'wb') as fh:
+                fh.write(b'data')
+            manifest = os.path.join(directory, 'manifest.txt')
+            with open(manifest, 'w', encoding='utf-8') as fh:
+                fh.write('./sub/f\t8d777f385d3dfec8815d20f7496026dc\n')
+            report = os.path.join(directory, 'report.txt')
+            process = run_cli(directory, report, '--manifest', manifest, '-r', '--exclude', '*.txt')
+            self.assertEqual(process.returncode, 0, process.stderr)
+            with open(report, encoding='utf-8') as fh:
+                self.assertNotIn('EXTRA', fh.read())
+
+    def test_manifest_algorithms_come_from_its_header(self):
+        # Verifying used to split lines by --algorithm, so a four digest manifest came out as all missing
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            for name in ('a', 'b'):
+                with open(os.path.join(source, name), 'wb') as fh:
+                    fh.write(name.encode())
+            manifest = os.path.join(directory, 'manifest.txt')
+            algorithms = [option for algorithm in ('md5', 'sha1', 'sha256', 'crc32') for option in ('-a', algorithm)]
+            self.assertEqual(run_cli(source, manifest, *algorithms).returncode, 0)
+            report = os.path.join(directory, 'report.txt')
+            process = run_cli(source, report, '--manifest', manifest)
+            self.assertEqual(process.returncode, 0, process.stderr)
+            with open(report, encoding='utf-8') as fh:
+                self.assertEqual(fh.read(), '# 2 ok, 0 mismatched, 0 missing, 0 extra, 0 malformed\n')
+
+    def test_digests_that_dont_fit_are_malformed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'f'), 'wb') as fh:
+                fh.write(b'data')
+            manifest = os.path.join(directory, 'manifest.txt')
+            with open(manifest, 'wb') as fh:
+                # A sha256 digest where md5 is expected, and a line that isn't UTF-8
+                fh.write(b'f\t3a6eb0790f39ac87c94f3856b2dd2c5d110e6811602261a9a923d3bb23adc8b7\n\xff\xfe\tx\n')
+            report = os.path.join(directory, 'report.txt')
+            process = run_cli(report, '--manifest', manifest)
+            self.assertEqual(process.returncode, 1, process.stderr)
+            self.assertNotIn('Traceback', process.stderr)
+            with open(report, encoding='utf-8') as fh:
+                self.assertIn('0 ok, 0 mismatched, 0 missing, 0 extra, 2 malformed', fh.read())
+
+
+class ErrorTest(unittest.TestCase):
+
+    def test_unwritable_destination_fails(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'a'), 'wb') as fh:
+                fh.write(b'data')
+            process = run_cli(directory, os.path.join(directory, 'missing', 'out.txt'))
+            self.assertEqual(process.returncode, 1)
+            self.assertIn('cannot open', process.stderr)
+
+    def test_failed_file_is_counted_and_fails(self):
+        # Running as root can read any file, so the failure is injected instead
+        script = (
+            'import sys, file_hasher_engine, file_hasher_cli\n'
+            'hash_file = file_hasher_engine.hash_file\n'
+            'def failing(path, *args, **kwargs):\n'
+            '    if path.endswith("bad"):\n'
+            '        raise PermissionError(13, "Permission denied", path)\n'
+            '    return hash_file(path, *args, **kwargs)\n'
+            'file_hasher_engine.hash_file = failing\n'
+            'sys.exit(file_hasher_cli.main(sys.argv[1:]))\n'
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            for name in ('good', 'bad'):
+                with open(os.path.join(source, name), 'wb') as fh:
+                    fh.write(name.encode())
+            process = subprocess.run([sys.executable, '-c', script, source, os.path.join(directory, 'out.txt')],
+                                     cwd=REPO, capture_output=True, text=True, timeout=60)
+            self.assertEqual(process.returncode, 1, process.stderr)
+            self.assertIn('error hashing', process.stderr)
+            self.assertEqual(json.loads(process.stderr.splitlines()[-1])['files_failed'], 1)
+
+    def test_unreadable_manifest_fails(self):
+        # Used to raise after the job had started, so finished was never emitted
+        with tempfile.TemporaryDirectory() as directory:
+            process = run_cli(os.path.join(directory, 'out.txt'), '--manifest', os.path.join(directory, 'missing'))
+            self.assertEqual(process.returncode, 1, process.stderr)
+            self.assertIn('error reading', process.stderr)
+
+    def test_undecodable_file_name_is_written(self):
+        # Used to raise UnicodeEncodeError in the writer thread, losing the batch while the job still succeeded
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            with open(os.path.join(os.fsencode(source), b'bad\xffname'), 'wb') as fh:
+                fh.write(b'data')
+            out = os.path.join(directory, 'out.txt')
+            process = run_cli(source, out)
+            self.assertEqual(process.returncode, 0, process.stderr)
+            with open(out, 'rb') as fh:
+                self.assertEqual(fh.read().splitlines()[1], os.path.join(os.fsencode(source), b'bad\xffname')
+                                 + b'\t8d777f385d3dfec8815d20f7496026dc')
+
+    def test_dead_worker_fails(self):
+        # Submitting to the broken pool used to raise BrokenProcessPool out of the job
+        script = (
+            'import os, sys\n'
+            f'sys.path.insert(0, {REPO!r})\n'
+            'import file_hasher_engine, file_hasher_cli\n'
+            'def dying(*args, **kwargs):\n'
+            '    os._exit(1)\n'
+            'if __name__ == "__main__":\n'
+            '    file_hasher_engine.hash_file = dying\n'
+            '    sys.exit(file_hasher_cli.main(sys.argv[1:]))\n'
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            for name in range(10):
+                with open(os.path.join(source, str(name)), 'wb') as fh:
+                    fh.write(b'data')
+            # A file rather than -c, so spawned workers can import dying from it
+            with open(os.path.join(directory, 'dying.py'), 'w', encoding='utf-8') as fh:
+                fh.write(script)
+            process = subprocess.run([sys.executable, os.path.join(directory, 'dying.py'), source,
+                                      os.path.join(directory, 'out.txt'), '--backend', 'processes', '-t', '1',
+                                      '--progress', 'none'], capture_output=True, text=True, timeout=60)
+            self.assertEqual(process.returncode, 1, process.stderr)
+            self.assertIn('hashing worker died', process.stderr)
+            self.assertNotIn('Traceback', process.stderr)
+
+    def test_unusable_cache_fails(self):
+        # Opening the cache used to raise sqlite3.OperationalError out of the job
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            for extra in ((), ('--forget', source)):
+                process = run_cli(source, os.path.join(directory, 'out.txt'), '--cache', directory, *extra)
+                self.assertEqual(process.returncode, 1, process.stderr)
+                self.assertIn('cannot open the cache', process.stderr)
+                self.assertNotIn('Traceback', process.stderr)
+
+    def test_undecodable_file_name_is_not_cached(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, 'source')
+            os.mkdir(source)
+            with open(os.path.join(os.fsencode(source), b'bad\xffname'), 'wb') as fh:
+                fh.write(b'data')
+            cache = os.path.join(directory, 'cache.sqlite3')
+            for _ in range(2):
+                process = run_cli(source, os.path.join(directory, 'out.txt'), '--cache', cache)
+                self.assertEqual(process.returncode, 0, process.stderr)
+
+    def test_threads_and_chunk_size_below_one_are_rejected(self):
+        # --threads 0 used to wait forever for a slot, --chunk-size 0 gave every file the empty digest
+        with tempfile.TemporaryDirectory() as directory:
+            for option in ('--threads', '--chunk-size'):
+                process = run_cli(directory, os.path.join(directory, 'out.txt'), option, '0')
+                self.assertEqual(process.returncode, 2)
+                self.assertIn(f'{option} must be at least 1', process.stderr)
+
+
+if __name__ == '__main__':
+    unittest.main()
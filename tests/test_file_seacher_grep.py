@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def grep(path, term, regex=True):
+    # In a subprocess, so a search that never ends fails the test instead of hanging it
+    script = ('import json, sys, file_seacher_grep\n'
+              'print(json.dumps(file_seacher_grep.grep_file(sys.argv[1], sys.argv[2], sys.argv[3] == "1")))\n')
+    process = subprocess.run([sys.executable, '-c', script, path, term, '1' if regex else '0'],
+                             cwd=REPO, capture_output=True, text=True, timeout=10)
+    return [tuple(hit) for hit in json.loads(process.stdout)]
+
+
+class GrepTest(unittest.TestCase):
+
+    def test_empty_matches_end(self):
+        # Used to find the same empty match at the end of the file forever
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'f')
+            for content, lines in ((b'one\ntwo\n', [(1, 'one'), (2, 'two')]),
+                                   (b'one\ntwo', [(1, 'one'), (2, 'two')])):
+                with open(path, 'wb') as fh:
+                    fh.write(content)
+                for term in ('$', '^', 'x*'):
+                    with self.subTest(content=content, term=term):
+                        self.assertEqual(grep(path, term), lines)
+
+    def test_plain_term(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'f')
+            with open(path, 'wb') as fh:
+                fh.write(b'abc\nxyz\nabcabc')
+            self.assertEqual(grep(path, 'abc', regex=False), [(1, 'abc'), (3, 'abcabc')])
+
+    def test_regex_matches_characters(self):
+        # The pattern was compiled as bytes, so \u escapes were errors and . matched a single byte
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'f')
+            with open(path, 'wb') as fh:
+                fh.write('tea\ncafé\n'.encode())
+            for term in ('caf\\u00e9', 'caf.$', 'é'):
+                with self.subTest(term=term):
+                    self.assertEqual(grep(path, term), [(2, 'café')])
+
+    def test_regex_line_numbers_across_blocks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'f')
+            with open(path, 'wb') as fh:
+                fh.write(b'filler line\n' * 200000 + 'naïve\n'.encode() + b'x' * 3000000 + b'\nnaive\n')
+            self.assertEqual(grep(path, '^na.ve$'), [(200001, 'naïve'), (200003, 'naive')])
+
+
+if __name__ == '__main__':
+    unittest.main()
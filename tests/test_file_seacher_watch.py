@@ -0,0 +1,56 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from file_seacher_watch import TreeWatcher  # noqa: E402
+
+
+class TreeWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        try:
+            self.watcher = TreeWatcher()
+        except OSError as error:
+            self.skipTest(f'inotify unavailable: {error}')
+        self.addCleanup(self.watcher.close)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        paths = [os.path.join(self.root, path) for path in ('a', 'a/b', 'a/b/c', 'd')]
+        for path in paths:
+            os.mkdir(path)
+        for path in [self.root, *paths]:
+            self.watcher.watch(path)
+
+    def take(self, expected):
+        changes = []
+        deadline = time.monotonic() + 5
+        while len(changes) < expected and time.monotonic() < deadline:
+            time.sleep(0.05)
+            changes += self.watcher.take()[0]
+        return changes
+
+    def test_moved_directory_unwatches_only_its_subtree(self):
+        os.rename(os.path.join(self.root, 'a'), os.path.join(self.root, 'x'))
+        changes = self.take(2)
+        self.assertIn((os.path.join(self.root, 'a'), True, False), changes)
+        self.assertEqual(sorted(self.watcher.wds), sorted([self.root, os.path.join(self.root, 'd')]))
+        self.assertEqual(sorted(self.watcher.paths.values()), sorted(self.watcher.wds))
+
+    def test_deleted_directory_is_forgotten_through_in_ignored(self):
+        os.rmdir(os.path.join(self.root, 'd'))
+        changes = self.take(1)
+        self.assertEqual(changes, [(os.path.join(self.root, 'd'), True, False)])
+        deadline = time.monotonic() + 5
+        while os.path.join(self.root, 'd') in self.watcher.wds and time.monotonic() < deadline:
+            time.sleep(0.05)
+            self.watcher.take()
+        self.assertNotIn(os.path.join(self.root, 'd'), self.watcher.wds)
+        self.assertIn(os.path.join(self.root, 'a', 'b', 'c'), self.watcher.wds)
+
+
+if __name__ == '__main__':
+    unittest.main()